@@ -0,0 +1,20 @@
+-- Columna Fuente en FactVentas para un DW creado antes de que existiera
+-- (ScriptCreaciónDW.sql ya la incluye). Los ETL escriben su fuente ('SQLSERVER',
+-- 'MONGODB', 'MYSQL', 'NEO4J') y los que hacen MERGE sobre FactVentas (SQL Server con
+-- --change-tracking, MongoDB) solo actualizan las filas de su fuente.
+-- Las filas existentes quedan con Fuente NULL y ningún MERGE las modifica. El ETL de
+-- SQL Server con --change-tracking se detiene si un grupo que va a aplicar coincide con
+-- una fila sin Fuente (de lo contrario insertaría una segunda fila con el total completo).
+-- Antes de usarlo hay que asignar la Fuente de las filas viejas o recargar el DW.
+USE DW_VENTAS;
+GO
+
+IF COL_LENGTH('dbo.FactVentas', 'Fuente') IS NULL
+    ALTER TABLE FactVentas ADD Fuente VARCHAR(20) NULL;
+GO
+
+-- Si todos los hechos existentes los cargó el ETL de SQL Server, descomentar:
+-- UPDATE FactVentas SET Fuente = 'SQLSERVER' WHERE Fuente IS NULL;
+-- GO
+-- Si no se sabe qué ETL cargó cada fila, borrar las filas sin Fuente y volver a cargarlas
+-- corriendo cada ETL desde cero (sin su marca de agua).
@@ -55,6 +55,8 @@ CREATE TABLE FactVentas (
     TotalVentas DECIMAL(18,2),
     Cantidad INT,
     Precio DECIMAL(18,2),
+    -- ETL que cargó la fila ('SQLSERVER', 'MONGODB', 'MYSQL', 'NEO4J'); los MERGE de cada ETL solo tocan sus filas
+    Fuente VARCHAR(20) NULL,
 
     CONSTRAINT FK_FactVentas_Tiempo FOREIGN KEY (IdTiempo)
         REFERENCES DimTiempo(IdTiempo),
@@ -95,3 +97,11 @@ CREATE TABLE Equivalencias (
     CodigoAlt VARCHAR(30) NULL
 );
 GO
+
+-- TABLA DE ESTADO DEL ETL DE MONGODB (marca de agua y resume token del change stream)
+CREATE TABLE EtlEstadoMongo (
+    Clave VARCHAR(50) PRIMARY KEY,
+    Valor NVARCHAR(MAX) NULL,
+    Actualizado DATETIME2 NOT NULL DEFAULT SYSDATETIME()
+);
+GO
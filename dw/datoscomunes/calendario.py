@@ -0,0 +1,76 @@
+import logging
+from datetime import datetime, timedelta
+
+
+def _a_fecha(valor):
+	"""Convierte datetime a date; deja los date tal cual."""
+	return valor.date() if isinstance(valor, datetime) else valor
+
+
+def generar_calendario(fecha_min, fecha_max):
+	"""Genera las filas de DimTiempo para cada día del rango [fecha_min, fecha_max].
+
+	Cada fila es (Anio, Mes, Dia, Fecha, Semana ISO, DiaSemana).
+	"""
+	fecha = _a_fecha(fecha_min)
+	fin = _a_fecha(fecha_max)
+	filas = []
+	while fecha <= fin:
+		filas.append((
+			fecha.year,
+			fecha.month,
+			fecha.day,
+			fecha,
+			fecha.isocalendar()[1],
+			fecha.strftime('%A'),
+		))
+		fecha += timedelta(days=1)
+	return filas
+
+
+def cargar_mapa_tiempo(connection, fecha_min, fecha_max):
+	"""Retorna {Fecha: IdTiempo} de DimTiempo para el rango indicado."""
+	cursor = connection.cursor()
+	cursor.execute(
+		"SELECT Fecha, IdTiempo FROM DimTiempo WHERE Fecha BETWEEN ? AND ?",
+		(_a_fecha(fecha_min), _a_fecha(fecha_max))
+	)
+	mapa = {}
+	for fecha, id_tiempo in cursor.fetchall():
+		mapa[_a_fecha(fecha)] = int(id_tiempo)
+	cursor.close()
+	return mapa
+
+
+def asegurar_dim_tiempo(connection, fecha_min, fecha_max, tipo_cambio=None):
+	"""Crea en un solo paso las fechas que faltan en DimTiempo para el rango indicado.
+
+	Calcula el calendario completo del rango, inserta en bloque (fast_executemany)
+	solo las fechas que no existen y retorna {Fecha: IdTiempo} del rango, de modo que
+	la resolución de la llave de tiempo en los ETL sea un lookup en un diccionario.
+	Las fechas nuevas se crean con `tipo_cambio`, por defecto NULL: el job del BCCR lo
+	completa luego y, mientras tanto, cada ETL aplica su arrastre o su tasa por defecto
+	en lugar de tomar un valor inventado como tasa publicada.
+	"""
+	if fecha_min is None or fecha_max is None:
+		return {}
+
+	mapa = cargar_mapa_tiempo(connection, fecha_min, fecha_max)
+	faltantes = [fila for fila in generar_calendario(fecha_min, fecha_max) if fila[3] not in mapa]
+
+	if faltantes:
+		cursor = connection.cursor()
+		cursor.fast_executemany = True
+		cursor.executemany(
+			"""
+			INSERT INTO DimTiempo (Anio, Mes, Dia, Fecha, Semana, DiaSemana, TipoCambio)
+			VALUES (?, ?, ?, ?, ?, ?, ?)
+			""",
+			[fila + (tipo_cambio,) for fila in faltantes]
+		)
+		connection.commit()
+		cursor.close()
+		logging.info(f"DimTiempo: {len(faltantes)} fechas creadas entre {_a_fecha(fecha_min)} y {_a_fecha(fecha_max)}")
+		mapa = cargar_mapa_tiempo(connection, fecha_min, fecha_max)
+
+	return mapa
@@ -0,0 +1,24 @@
+import platform
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+
+def get_peak_rss_mb():
+	"""Retorna el pico de memoria residente (RSS) del proceso en MB.
+
+	En Windows usa psutil si está instalado; retorna None si no se puede medir.
+	"""
+	if resource is not None:
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		# macOS reporta bytes, Linux reporta KB
+		if platform.system() == "Darwin":
+			return peak / (1024 * 1024)
+		return peak / 1024
+	try:
+		import psutil
+		return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+	except Exception:
+		return None
@@ -0,0 +1,77 @@
+import argparse
+import time
+
+from etl import MongoToDW_ETL
+
+
+# compara la agregación de ventas con un solo pipeline contra la agregación por shards de fechas en paralelo
+# solo lee de MongoDB (no escribe nada en el DW), sobre todo el historial de órdenes
+
+
+def resumen(ventas):
+    # para revisar que los dos caminos dan lo mismo
+    claves = {str(sorted(venta['_id'].items())) for venta in ventas}
+    cantidad = sum(venta['cantidad_total'] for venta in ventas)
+    total = sum(venta['total_ventas_crc'] for venta in ventas)
+    return len(ventas), len(claves), cantidad, total
+
+
+def medir(funcion, repeticiones):
+    tiempos = []
+    ventas = None
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        ventas = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos), ventas
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de la agregación de ventas de MongoDB')
+    parser.add_argument('--hilos', type=int, nargs='+', default=[2, 4, 8], help='Cantidades de hilos a probar')
+    parser.add_argument('--shard-dias', type=int, nargs='+', default=[7, 30, 90], help='Tamaños de shard (días) a probar')
+    parser.add_argument('--repeticiones', type=int, default=3, help='Repeticiones por caso (se reporta el mejor tiempo)')
+    args = parser.parse_args()
+
+    etl = MongoToDW_ETL()
+    etl.connect_mongo()
+
+    try:
+        ordenes_collection = etl.mongo_db['ordenes']
+        marca_alta = etl.obtener_marca_alta(ordenes_collection)
+        if not marca_alta:
+            print("No hay órdenes en MongoDB")
+            return
+
+        desde = etl.obtener_marca_baja(ordenes_collection)
+        filtro = etl.filtro_extraccion(None, marca_alta)
+        print(f"Órdenes entre {desde} y {marca_alta[0]}")
+
+        def un_pipeline():
+            return list(ordenes_collection.aggregate(
+                etl.pipeline_ventas(filtro),
+                allowDiskUse=True,
+                batchSize=etl.batch_size
+            ))
+
+        segundos_base, ventas_base = medir(un_pipeline, args.repeticiones)
+        esperado = resumen(ventas_base)
+
+        print(f"{'modo':<12}{'hilos':>6}{'dias':>6}{'segundos':>10}{'ventas':>9}{'speedup':>9}  ok")
+        print(f"{'un pipeline':<12}{1:>6}{'-':>6}{segundos_base:>10.2f}{esperado[0]:>9}{1.0:>9.2f}  si")
+
+        for hilos in args.hilos:
+            for dias in args.shard_dias:
+                def por_shards():
+                    return list(etl.agregar_por_shards(ordenes_collection, filtro, desde, marca_alta[0], dias, hilos))
+
+                segundos, ventas = medir(por_shards, args.repeticiones)
+                ok = 'si' if resumen(ventas) == esperado else 'NO'
+                print(f"{'shards':<12}{hilos:>6}{dias:>6}{segundos:>10.2f}{len(ventas):>9}{segundos_base / segundos:>9.2f}  {ok}")
+
+    finally:
+        etl.mongo_client.close()
+
+
+if __name__ == "__main__":
+    main()
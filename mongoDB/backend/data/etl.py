@@ -1,12 +1,104 @@
 import pymongo
 import pyodbc
+import argparse
+import time
+from bson import json_util
 from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import platform
 import os
+import json
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
 
+
+class AsignadorSKU:
+    # reparte los SKU-0000 a SKU-9999 para los productos de mongo que no traen sku
+    # bitmap = qué números ya están ocupados, libres = cola de números para cuando hay choque
+    # lo asignado se guarda en un json para que cada codigo_mongo reciba siempre el mismo sku
+    TAMANO = 10000
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.bitmap = bytearray(self.TAMANO // 8)
+        self.asignados = {}
+        self.libres = None
+        self.cambios = False
+
+    def numero(self, sku):
+        # 'SKU-1234' -> 1234, None si no tiene el formato o se sale del rango
+        if not sku or not sku.startswith('SKU-'):
+            return None
+        resto = sku[4:]
+        if not resto.isdigit() or int(resto) >= self.TAMANO:
+            return None
+        return int(resto)
+
+    def ocupado(self, numero):
+        return self.bitmap[numero >> 3] & (1 << (numero & 7)) != 0
+
+    def marcar(self, sku):
+        numero = self.numero(sku)
+        if numero is not None:
+            self.bitmap[numero >> 3] |= 1 << (numero & 7)
+
+    def siguiente_libre(self):
+        # la cola se arma una sola vez en orden ascendente (así siempre sale igual);
+        # los que se ocuparon después se van descartando al sacarlos
+        if self.libres is None:
+            self.libres = deque(n for n in range(self.TAMANO) if not self.ocupado(n))
+        while self.libres:
+            numero = self.libres.popleft()
+            if not self.ocupado(numero):
+                return numero
+        return None
+
+    def asignar(self, codigo_mongo, preferido):
+        if codigo_mongo in self.asignados:
+            return self.asignados[codigo_mongo]
+
+        if preferido is not None and preferido < self.TAMANO and not self.ocupado(preferido):
+            numero = preferido
+        else:
+            numero = self.siguiente_libre()
+            if numero is None:
+                raise ValueError("No quedan SKUs libres entre SKU-0000 y SKU-9999")
+
+        sku = f'SKU-{str(numero).zfill(4)}'
+        self.marcar(sku)
+        self.asignados[codigo_mongo] = sku
+        self.cambios = True
+        return sku
+
+    def cargar(self):
+        try:
+            if not os.path.exists(self.ruta):
+                return
+            with open(self.ruta, 'r', encoding='utf-8') as f:
+                self.asignados = json.load(f)
+            for sku in self.asignados.values():
+                self.marcar(sku)
+            print(f"SKUs asignados previamente: {len(self.asignados)}")
+        except Exception as e:
+            print(f"Error leyendo SKUs asignados: {e}")
+
+    def guardar(self):
+        if not self.cambios:
+            return
+        try:
+            # archivo temporal + reemplazo para no dejarlo a medias
+            tmp_path = self.ruta + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.asignados, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.ruta)
+            self.cambios = False
+        except Exception as e:
+            print(f"Error guardando SKUs asignados: {e}")
+
+
 class MongoToDW_ETL:
     def __init__(self):
         
@@ -32,8 +124,34 @@ class MongoToDW_ETL:
     
         self.log_file_path = os.path.join(os.path.dirname(__file__), 'etl_execution.log')
         
+        # tamaño de lote para leer el cursor de MongoDB y escribir en el DW
+        self.batch_size = int(os.getenv("ETL_BATCH_SIZE", "1000"))
+        
+        # agregación en paralelo por shards de fechas (1 hilo = un solo pipeline)
+        self.hilos = int(os.getenv("ETL_HILOS", "1"))
+        self.shard_dias = int(os.getenv("ETL_SHARD_DIAS", "30"))
+        
+        # parámetros por consulta en las búsquedas/inserciones por lote de dimensiones
+        self.max_parametros = 2000
+        
+        # columna Fuente de FactVentas: el MERGE solo suma sobre filas cargadas por este ETL
+        self.fuente = 'MONGODB'
+        
+        # modo change stream: se aplica un micro-lote cada N segundos o M eventos (lo que pase primero)
+        self.stream_intervalo = float(os.getenv("ETL_STREAM_INTERVALO", "5"))
+        self.stream_max_eventos = int(os.getenv("ETL_STREAM_MAX_EVENTOS", "500"))
         
-        self.skus_generados = set()
+        
+        self.asignador_sku = AsignadorSKU(os.path.join(os.path.dirname(__file__), 'skus_asignados.json'))
+
+        # última marca de agua escrita por el modo continuo
+        self.marca_stream = None
+        # hasta dónde llegó la puesta al día en batch antes de abrir el stream (esas órdenes no se repiten)
+        self.marca_puesta_al_dia = None
+        
+        # DimTiempo en memoria (lo llena cargar_dim_tiempo)
+        self.mapa_tiempo = {}
+        self.fechas_faltantes = set()
 
         self.genero_mapping = {
             'Masculino': 'M',
@@ -47,39 +165,16 @@ class MongoToDW_ETL:
         if not codigo_mongo:
             return None
         
-        # agarramos y ponemos los números al revés
+        # agarramos y ponemos los números al revés, ese es el sku que preferimos
+        # si ya está ocupado el asignador da el siguiente libre
         if codigo_mongo.startswith('MN-'):
-            numero = codigo_mongo[3:]  
-            numero_invertido = numero[::-1]
-            sku = f'SKU-{numero_invertido}'
-            
-            # si ya existe, sumamos 1 hasta encontrar uno nuevo
-            contador = 0
-            sku_original = sku
-            while sku in self.skus_generados:
-                contador += 1
-                numero_modificado = str(int(numero_invertido) + contador).zfill(4)
-                sku = f'SKU-{numero_modificado}'
-            
-            self.skus_generados.add(sku)
-            return sku
+            numero = codigo_mongo[3:]
         else:
             # lo mismo pero para códigos que no siguen el formato MN-XXXX
-            numero_limpio = ''.join(filter(str.isdigit, codigo_mongo))  
-            if numero_limpio:
-                numero_invertido = numero_limpio[::-1]
-                sku = f'SKU-{numero_invertido.zfill(4)}'
-                
-                s
-                contador = 0
-                while sku in self.skus_generados:
-                    contador += 1
-                    numero_modificado = str(int(numero_invertido) + contador).zfill(4)
-                    sku = f'SKU-{numero_modificado}'
-                
-                self.skus_generados.add(sku)
-                return sku
-            return 'SKU-0000'
+            numero = ''.join(filter(str.isdigit, codigo_mongo))
+        
+        preferido = int(numero[::-1]) if numero.isdigit() else None
+        return self.asignador_sku.asignar(codigo_mongo, preferido)
         
     def ultima_ejecucion(self):
         # esta es la parte que evita que metamos duplicados o así
@@ -107,15 +202,62 @@ class MongoToDW_ETL:
             print(f"Error leyendo archivo de log: {e}")
             return None
     
-    def registrar_log(self, ultima_fecha_procesada):
-        try:
-            with open(self.log_file_path, 'w', encoding='utf-8') as f:
-                f.write(ultima_fecha_procesada.strftime('%Y-%m-%d'))
-                
-            print(f"Fecha registrada en log: {ultima_fecha_procesada}")
-            
-        except Exception as e:
-            print(f"Error escribiendo en archivo de log: {e}")
+    def leer_marca_agua(self):
+        # (fecha, _id) de la última orden cargada, guardada en EtlEstadoMongo
+        valor = self.leer_estado('watermark')
+        if valor:
+            marca = json_util.loads(valor)
+            return marca['fecha'], marca['id']
+        
+        # si solo está el log viejo (etl_execution.log, únicamente la fecha) se sigue desde el día siguiente
+        last_execution_date = self.ultima_ejecucion()
+        if last_execution_date:
+            next_day = last_execution_date + timedelta(days=1)
+            return datetime.combine(next_day, datetime.min.time()), None
+        
+        return None
+    
+    def marca_mayor(self, marca, actual):
+        # True si la marca (fecha, _id) va después de la actual
+        # (la del log viejo no trae _id: las órdenes de esa misma fecha todavía no se cargaron)
+        if actual is None:
+            return True
+        if marca[0] != actual[0]:
+            return marca[0] > actual[0]
+        return actual[1] is None or marca[1] > actual[1]
+    
+    def obtener_marca_alta(self, ordenes_collection):
+        orden = ordenes_collection.find_one(
+            {},
+            {'fecha': 1},
+            sort=[('fecha', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+        )
+        if not orden:
+            return None
+        return orden['fecha'], orden['_id']
+    
+    def filtro_extraccion(self, marca_agua, marca_alta):
+        # órdenes en el rango (marca_agua, marca_alta] ordenando por (fecha, _id)
+        # el rango sobre 'fecha' va aparte para que Mongo use el índice (fecha, _id)
+        fecha_alta, id_alto = marca_alta
+        rango_fecha = {'$lte': fecha_alta}
+        condiciones = [
+            {'$or': [
+                {'fecha': {'$lt': fecha_alta}},
+                {'fecha': fecha_alta, '_id': {'$lte': id_alto}}
+            ]}
+        ]
+        
+        if marca_agua:
+            fecha_baja, id_bajo = marca_agua
+            rango_fecha['$gte'] = fecha_baja
+            if id_bajo is not None:
+                condiciones.append({'$or': [
+                    {'fecha': {'$gt': fecha_baja}},
+                    {'fecha': fecha_baja, '_id': {'$gt': id_bajo}}
+                ]})
+        
+        return {'fecha': rango_fecha, '$and': condiciones}
     
     def connect_mongo(self):
         try:
@@ -135,169 +277,218 @@ class MongoToDW_ETL:
             print(f"Error conectando a SQL Server: {e}")
             raise
     
-    def tc_dia(self, fecha):
-
+    def cargar_dim_tiempo(self, fecha_desde=None):
+        # una sola consulta a DimTiempo para toda la ejecución: fecha -> (IdTiempo, TipoCambio)
+        self.mapa_tiempo = {}
+        self.fechas_faltantes = set()
+        
         try:
             cursor = self.sql_connection.cursor()
-            query = """
-                SELECT TipoCambio 
-                FROM DimTiempo 
-                WHERE Fecha = ?
-            """
-            cursor.execute(query, fecha.date())
-            result = cursor.fetchone()
-            
-            if result and result[0]:
-                return float(result[0])
+            if fecha_desde:
+                cursor.execute("SELECT Fecha, IdTiempo, TipoCambio FROM DimTiempo WHERE Fecha >= ?", fecha_desde)
             else:
-                return 500.00 
-                    
-        except Exception as e:
-            print(f"Error obteniendo tipo de cambio: {e}")
-            return 500.00
-    
-    def obtener_cliente(self, cliente_data):
-        try:
-            cursor = self.sql_connection.cursor()
+                cursor.execute("SELECT Fecha, IdTiempo, TipoCambio FROM DimTiempo")
             
-
-            query = "SELECT IdCliente FROM DimCliente WHERE Email = ?"
-            cursor.execute(query, cliente_data['email'])
-            result = cursor.fetchone()
-            
-            if result:
-                return result[0]
-            
-            # si no lo encuentra crea uno
-            genero_mapeado = self.genero_mapping.get(cliente_data['genero'], 'N')
-            
-            insert_query = """
-                INSERT INTO DimCliente (Nombre, Email, Genero, Pais, FechaCreacion)
-                VALUES (?, ?, ?, ?, ?)
-            """
-            cursor.execute(insert_query, (
-                cliente_data['nombre'],
-                cliente_data['email'],
-                genero_mapeado,
-                cliente_data['pais'],
-                cliente_data['creado'].date()
-            ))
-            
-            cursor.execute("SELECT @@IDENTITY")
-            cliente_id = cursor.fetchone()[0]
-            self.sql_connection.commit()
+            for fecha, id_tiempo, tipo_cambio in cursor.fetchall():
+                # si hay fechas repetidas nos quedamos con la primera
+                if fecha not in self.mapa_tiempo:
+                    self.mapa_tiempo[fecha] = (id_tiempo, float(tipo_cambio) if tipo_cambio else None)
             
-           
-            return int(cliente_id)
+            cursor.close()
+            print(f"DimTiempo cargado en memoria: {len(self.mapa_tiempo)} fechas")
             
         except Exception as e:
-            print(f"Error procesando cliente: {e}")
-            return None
+            print(f"Error cargando DimTiempo: {e}")
     
-    def obtener_producto(self, producto_data):
-        try:
-            cursor = self.sql_connection.cursor()
-            
-            codigo_mongo = producto_data.get('codigo_mongo')
-            nombre = producto_data.get('nombre', 'Sin Nombre')
-            categoria = producto_data.get('categoria', 'Sin Categoria')
-            equivalencias = producto_data.get('equivalencias', {})
-            
-            
-            if not codigo_mongo:
-                return None
-            
-            sku_from_equivalencias = equivalencias.get('sku')
-            codigo_alt = equivalencias.get('codigo_alt')
-            
-            # primero buscamos si ya hay equivalencias para el código mongo
-            equivalencia_id = None
-            sku_existente = None
-            producto_id = None
-            
-            if codigo_mongo:
-                query = "SELECT Id, SKU FROM Equivalencias WHERE CodigoMongo = ?"
-                cursor.execute(query, codigo_mongo)
-                result = cursor.fetchone()
-                if result:
-                    equivalencia_id = result[0]
-                    sku_existente = result[1]
-            
-            # si sí, buscamos el product por su sku
-            if equivalencia_id and sku_existente:
-                sku_final = sku_existente
-                
-                
-                
-                query = "SELECT IdProducto FROM DimProducto WHERE SKU = ?"
-                cursor.execute(query, sku_final)
-                result = cursor.fetchone()
-                if result:
-                    producto_id = result[0]
-                    return int(producto_id)
-            
-            
-            if not equivalencia_id:
-                # generamos el sku desde el codigo mongo
-                sku_generado = self.mongo_a_sku(codigo_mongo) if codigo_mongo else None
-                sku_final = sku_from_equivalencias or sku_generado
-                
-                # buscamos por ese sku
-                if sku_final:
-                    query = "SELECT Id FROM Equivalencias WHERE SKU = ?"
-                    cursor.execute(query, sku_final)
-                    result = cursor.fetchone()
-                    if result:
-                        equivalencia_id = result[0]
-                        
-                
-                # sino por código alternativo
-                if not equivalencia_id and codigo_alt:
-                    query = "SELECT Id FROM Equivalencias WHERE CodigoAlt = ?"
-                    cursor.execute(query, codigo_alt)
-                    result = cursor.fetchone()
-                    if result:
-                        equivalencia_id = result[0]
-                        
-                
-                # si no hay, hacemos una nueva equivalencia
-                if not equivalencia_id:
-                    insert_query = """
-                        INSERT INTO Equivalencias (SKU, CodigoMongo, CodigoAlt)
-                        VALUES (?, ?, ?)
-                    """
-                    cursor.execute(insert_query, (sku_final, codigo_mongo, codigo_alt))
-                    cursor.execute("SELECT @@IDENTITY")
-                    equivalencia_id = cursor.fetchone()[0]
-                    
+    def tc_dia(self, fecha):
+        tiempo = self.mapa_tiempo.get(fecha.date())
+        
+        if tiempo and tiempo[1]:
+            return tiempo[1]
+        else:
+            return 500.00 
+    
+    def normalizar(self, valor):
+        # la intercalación del DW no distingue mayúsculas ni espacios al final ('Web' = 'WEB '):
+        # las llaves de los diccionarios se comparan igual que el IN (...) de SQL Server
+        if isinstance(valor, str):
+            return valor.casefold().rstrip()
+        return valor
+    
+    def buscar_llaves(self, cursor, tabla, columna_clave, columna_id, valores):
+        # clave normalizada -> valor de columna_id, con un SELECT ... WHERE clave IN (...) por bloque
+        # (SQL Server acepta ~2100 parámetros por consulta)
+        valores = list(valores)
+        llaves = {}
+        for i in range(0, len(valores), self.max_parametros):
+            bloque = valores[i:i + self.max_parametros]
+            marcas = ', '.join('?' * len(bloque))
+            cursor.execute(
+                f"SELECT {columna_clave}, {columna_id} FROM {tabla} WHERE {columna_clave} IN ({marcas})",
+                bloque
+            )
+            for clave, id_valor in cursor.fetchall():
+                # si hay repetidos en el DW nos quedamos con el primero
+                llaves.setdefault(self.normalizar(clave), id_valor)
+        return llaves
+    
+    def insertar_llaves(self, cursor, tabla, columnas, filas, columna_clave, columna_id):
+        # inserta varias filas por sentencia y recupera las llaves nuevas con OUTPUT INSERTED
+        llaves = {}
+        if not filas:
+            return llaves
+        
+        por_sentencia = max(1, min(1000, self.max_parametros // len(columnas)))
+        marcas_fila = '(' + ', '.join('?' * len(columnas)) + ')'
+        for i in range(0, len(filas), por_sentencia):
+            bloque = filas[i:i + por_sentencia]
+            cursor.execute(
+                f"INSERT INTO {tabla} ({', '.join(columnas)}) "
+                f"OUTPUT INSERTED.{columna_clave}, INSERTED.{columna_id} "
+                f"VALUES {', '.join([marcas_fila] * len(bloque))}",
+                [valor for fila in bloque for valor in fila]
+            )
+            for clave, id_valor in cursor.fetchall():
+                llaves[self.normalizar(clave)] = id_valor
+        return llaves
+    
+    def obtener_clientes(self, cursor, clientes_data):
+        # email (normalizado) -> IdCliente, creando de una vez los que no existen
+        # en el DW se busca y se guarda el email tal cual viene
+        # los clientes sin email se crean con Email NULL y quedan con su _id de mongo como llave
+        por_email = {}
+        sin_email = []
+        for cliente_data in clientes_data:
+            if cliente_data.get('email'):
+                por_email.setdefault(self.normalizar(cliente_data['email']), cliente_data)
             else:
-                sku_final = sku_existente
-            
-            # buscamos el producto por su sku
-            if sku_final:
-                query = "SELECT IdProducto FROM DimProducto WHERE SKU = ?"
-                cursor.execute(query, sku_final)
+                sin_email.append(cliente_data)
+        
+        llaves = self.buscar_llaves(
+            cursor, 'DimCliente', 'Email', 'IdCliente', [cliente_data['email'] for cliente_data in por_email.values()]
+        )
+        
+        # si no lo encuentra crea uno
+        nuevos = []
+        for email, cliente_data in por_email.items():
+            if email in llaves:
+                continue
+            nuevos.append(self.fila_cliente(cliente_data))
+        
+        llaves.update(self.insertar_llaves(
+            cursor, 'DimCliente', ['Nombre', 'Email', 'Genero', 'Pais', 'FechaCreacion'], nuevos, 'Email', 'IdCliente'
+        ))
+        
+        for cliente_data in sin_email:
+            # se reusa el que ya se creó en otra ejecución con el mismo nombre, país y fecha de creación
+            fila = self.fila_cliente(cliente_data)
+            cursor.execute("""
+                SELECT TOP 1 IdCliente FROM DimCliente
+                WHERE Email IS NULL AND Nombre = ? AND Pais = ? AND FechaCreacion = ?
+            """, (fila[0], fila[3], fila[4]))
+            result = cursor.fetchone()
+            if not result:
+                cursor.execute("""
+                    INSERT INTO DimCliente (Nombre, Email, Genero, Pais, FechaCreacion)
+                    OUTPUT INSERTED.IdCliente
+                    VALUES (?, ?, ?, ?, ?)
+                """, fila)
                 result = cursor.fetchone()
-                if result:
-                    producto_id = result[0]
+            llaves[cliente_data['_id']] = result[0]
+        
+        return llaves
+    
+    def fila_cliente(self, cliente_data):
+        genero_mapeado = self.genero_mapping.get(cliente_data.get('genero'), 'N')
+        creado = cliente_data.get('creado')
+        return (
+            cliente_data.get('nombre'),
+            cliente_data.get('email') or None,
+            genero_mapeado,
+            cliente_data.get('pais'),
+            creado.date() if creado else None
+        )
+    
+    def obtener_productos(self, cursor, productos_data):
+        # codigo_mongo (normalizado) -> IdProducto; mismas reglas que antes pero con una consulta por paso para todo el lote
+        por_codigo = {}
+        for producto_data in productos_data:
+            if producto_data.get('codigo_mongo'):
+                por_codigo.setdefault(self.normalizar(producto_data['codigo_mongo']), producto_data)
+        
+        # primero buscamos si ya hay equivalencias para el código mongo (codigo_mongo -> SKU)
+        sku_equivalencias = self.buscar_llaves(
+            cursor, 'Equivalencias', 'CodigoMongo', 'SKU',
+            [producto_data['codigo_mongo'] for producto_data in por_codigo.values()]
+        )
+        
+        sku_por_codigo = {}
+        sin_equivalencia = []
+        for codigo, producto_data in por_codigo.items():
+            codigo_mongo = producto_data['codigo_mongo']
+            if codigo in sku_equivalencias:
+                sku_por_codigo[codigo] = sku_equivalencias[codigo]
+                continue
             
-            # si no existe el producto, lo creamos
-            if not producto_id:
-                insert_query = """
-                    INSERT INTO DimProducto (SKU, Nombre, Categoria)
+            # generamos el sku desde el codigo mongo (solo si no viene en las equivalencias)
+            equivalencias = producto_data.get('equivalencias') or {}
+            sku_final = equivalencias.get('sku')
+            if sku_final:
+                self.asignador_sku.marcar(sku_final)
+            else:
+                sku_final = self.mongo_a_sku(codigo_mongo)
+            sku_por_codigo[codigo] = sku_final
+            sin_equivalencia.append((sku_final, codigo_mongo, equivalencias.get('codigo_alt')))
+        
+        # si no hay equivalencia ni por sku ni por código alternativo, hacemos una nueva
+        if sin_equivalencia:
+            por_sku = self.buscar_llaves(cursor, 'Equivalencias', 'SKU', 'Id', {fila[0] for fila in sin_equivalencia})
+            por_alt = self.buscar_llaves(
+                cursor, 'Equivalencias', 'CodigoAlt', 'Id', {fila[2] for fila in sin_equivalencia if fila[2]}
+            )
+            # dos códigos mongo pueden traer el mismo sku o código alternativo: una sola equivalencia por cada uno
+            nuevas = []
+            skus_nuevos = set()
+            alts_nuevos = set()
+            for fila in sin_equivalencia:
+                sku_final = self.normalizar(fila[0])
+                codigo_alt = self.normalizar(fila[2])
+                if sku_final in por_sku or sku_final in skus_nuevos:
+                    continue
+                if codigo_alt and (codigo_alt in por_alt or codigo_alt in alts_nuevos):
+                    continue
+                nuevas.append(fila)
+                skus_nuevos.add(sku_final)
+                if codigo_alt:
+                    alts_nuevos.add(codigo_alt)
+            if nuevas:
+                cursor.fast_executemany = True
+                cursor.executemany("""
+                    INSERT INTO Equivalencias (SKU, CodigoMongo, CodigoAlt)
                     VALUES (?, ?, ?)
-                """
-                cursor.execute(insert_query, (sku_final, nombre, categoria))
-                cursor.execute("SELECT @@IDENTITY")
-                producto_id = cursor.fetchone()[0]
-                
-            
-            self.sql_connection.commit()
-            return int(producto_id)
-            
-        except Exception as e:
-            print(f"Error procesando producto: {e}")
-            return None
+                """, nuevas)
+        
+        # buscamos los productos por su sku y creamos los que falten
+        skus = {sku for sku in sku_por_codigo.values() if sku}
+        ids_por_sku = self.buscar_llaves(cursor, 'DimProducto', 'SKU', 'IdProducto', skus)
+        
+        nuevos = {}
+        for codigo, sku in sku_por_codigo.items():
+            if sku and self.normalizar(sku) not in ids_por_sku and self.normalizar(sku) not in nuevos:
+                producto_data = por_codigo[codigo]
+                nuevos[self.normalizar(sku)] = (
+                    sku, producto_data.get('nombre', 'Sin Nombre'), producto_data.get('categoria', 'Sin Categoria')
+                )
+        
+        ids_por_sku.update(self.insertar_llaves(
+            cursor, 'DimProducto', ['SKU', 'Nombre', 'Categoria'], list(nuevos.values()), 'SKU', 'IdProducto'
+        ))
+        
+        return {
+            codigo: ids_por_sku[self.normalizar(sku)]
+            for codigo, sku in sku_por_codigo.items()
+            if sku and self.normalizar(sku) in ids_por_sku
+        }
     
     def check_field_exists(self, table, field, id_value):
         try:
@@ -310,235 +501,607 @@ class MongoToDW_ETL:
             return False
     
     def get_tiempo_id(self, fecha):
-        try:
-            cursor = self.sql_connection.cursor()
-            query = "SELECT IdTiempo FROM DimTiempo WHERE Fecha = ?"
-            cursor.execute(query, fecha.date())
-            result = cursor.fetchone()
-            
-            if result:
-                return result[0]
-            else:
-                return None
-                
-        except Exception as e:
-            print(f"Error obteniendo IdTiempo: {e}")
+        tiempo = self.mapa_tiempo.get(fecha.date())
+        
+        if tiempo:
+            return tiempo[0]
+        else:
+            # se reporta al final de la ejecución
+            self.fechas_faltantes.add(fecha.date())
             return None
     
-    def obtener_canal(self, canal_nombre):
-        try:
-            cursor = self.sql_connection.cursor()
-            
+    def obtener_canales(self, cursor, canales):
+        # nombre (normalizado) -> IdCanal; si no existe, hay que crear uno nuevo
+        por_nombre = {}
+        for canal in canales:
+            por_nombre.setdefault(self.normalizar(canal), canal)
+        llaves = self.buscar_llaves(cursor, 'DimCanal', 'Nombre', 'IdCanal', por_nombre.values())
+        nuevos = [(canal,) for nombre, canal in por_nombre.items() if nombre not in llaves]
+        llaves.update(self.insertar_llaves(cursor, 'DimCanal', ['Nombre'], nuevos, 'Nombre', 'IdCanal'))
+        return llaves
+
+    def cargar_atributos(self, ventas):
+        # los datos de clientes y productos se traen una sola vez por _id, solo con los campos que usa el DW
+        cliente_ids = list({venta['_id']['cliente_id'] for venta in ventas})
+        producto_ids = list({venta['_id']['producto_id'] for venta in ventas})
         
-            query = "SELECT IdCanal FROM DimCanal WHERE Nombre = ?"
-            cursor.execute(query, canal_nombre)
-            result = cursor.fetchone()
-            
-            if result:
-                return result[0]
-            
-            # si no existe, hay que crear uno nuevo
-            insert_query = """
-                INSERT INTO DimCanal (Nombre)
-                VALUES (?)
-            """
-            cursor.execute(insert_query, canal_nombre)
-            
-            cursor.execute("SELECT @@IDENTITY")
-            canal_id = cursor.fetchone()[0]
-            self.sql_connection.commit()
-            
-            return int(canal_id)
-            
-        except Exception as e:
-            print(f"Error procesando canal: {e}")
-            return None
+        clientes = {}
+        for cliente in self.mongo_db['clientes'].find(
+            {'_id': {'$in': cliente_ids}},
+            {'nombre': 1, 'email': 1, 'genero': 1, 'pais': 1, 'creado': 1}
+        ):
+            clientes[cliente['_id']] = cliente
+        
+        productos = {}
+        for producto in self.mongo_db['productos'].find(
+            {'_id': {'$in': producto_ids}},
+            {'codigo_mongo': 1, 'nombre': 1, 'categoria': 1, 'equivalencias': 1}
+        ):
+            productos[producto['_id']] = producto
+        
+        return clientes, productos
 
-    def procesar_ordenes(self, limit=None):
+    def leer_lotes(self, cursor, tamano):
+        # agrupa los documentos del cursor en listas de "tamano" para procesarlos por lote
+        lote = []
         try:
-            
-            last_execution_date = self.ultima_ejecucion()
-            
-            ordenes_collection = self.mongo_db['ordenes']
-            
+            for documento in cursor:
+                lote.append(documento)
+                if len(lote) >= tamano:
+                    yield lote
+                    lote = []
+            if lote:
+                yield lote
+        finally:
+            cursor.close()
+    
+    def transformar_lote(self, lote):
+        # resuelve las llaves del DW de un lote de ventas agregadas y arma las filas de FactVentas
+        # retorna (filas, errores)
+        clientes, productos = self.cargar_atributos(lote)
+        filas = []
+        errores = 0
+        
+        # dimensiones en dos pasos para todo el lote: buscar con IN (...) y crear las que falten
+        cursor = self.sql_connection.cursor()
+        try:
+            cliente_ids = self.obtener_clientes(cursor, clientes.values())
+            producto_ids = self.obtener_productos(cursor, productos.values())
+            canal_ids = self.obtener_canales(cursor, {venta['_id']['canal'] for venta in lote})
+        finally:
+            cursor.close()
+        
+        for venta in lote:
+            try:
+                
+                fecha = venta['fecha_original']
+                cantidad_total = venta['cantidad_total']
+                total_crc = venta['total_ventas_crc']
+                precio_unit_crc = venta['precio_unit_promedio'] 
+                canal = venta['_id']['canal']
+                
+                
+                # si la orden apunta a un cliente/producto que no existe se cuenta como error
+                cliente_data = clientes.get(venta['_id']['cliente_id'])
+                producto_data = productos.get(venta['_id']['producto_id'])
+                if not cliente_data or not producto_data:
+                    errores += 1
+                    continue
+                
+                email = cliente_data.get('email')
+                cliente_id = cliente_ids.get(self.normalizar(email) if email else cliente_data['_id'])
+                if not cliente_id:
+                    errores += 1
+                    continue
+                
+         
+                producto_id = producto_ids.get(self.normalizar(producto_data.get('codigo_mongo')))
+                if not producto_id:
+                    errores += 1
+                    continue
+                
+               
+                canal_id = canal_ids.get(self.normalizar(canal))
+                if not canal_id:
+                    errores += 1
+                    continue
+                
            
-            pipeline = [
-                {
-                    '$lookup': {
-                        'from': 'clientes',
-                        'localField': 'cliente_id',
-                        'foreignField': '_id',
-                        'as': 'cliente_data'
-                    }
-                },
-                {
-                    '$unwind': '$cliente_data'
-                },
-                {
-                    '$unwind': '$items'
-                },
-                {
-                    '$lookup': {
-                        'from': 'productos',
-                        'localField': 'items.producto_id',
-                        'foreignField': '_id',
-                        'as': 'producto_data'
-                    }
-                },
-                {
-                    '$unwind': '$producto_data'
-                }
-            ]
+                tiempo_id = self.get_tiempo_id(fecha)
+                if not tiempo_id:
+                    errores += 1
+                    continue
+                
+              
+                tipo_cambio = self.tc_dia(fecha)
+                precio_unit_usd = precio_unit_crc / tipo_cambio
+                total_usd = total_crc / tipo_cambio
+                
+                filas.append((
+                    tiempo_id,
+                    producto_id,
+                    cliente_id,
+                    canal_id,
+                    round(total_usd, 2),
+                    cantidad_total,
+                    round(precio_unit_usd, 2)
+                ))
             
-            # para no meter repetidos!!!!
-            if last_execution_date:
-                next_day = last_execution_date + timedelta(days=1)
-                date_filter = {
-                    '$match': {
-                        'fecha': {
-                            '$gte': datetime.combine(next_day, datetime.min.time())
-                        }
-                    }
+            except Exception as e:
+                print(f"Error procesando venta agregada: {e}")
+                errores += 1
+                continue
+        
+        return filas, errores
+    
+    def pipeline_ventas(self, match):
+        # primero el filtro por fecha y solo los campos que se usan, sin los datos del cliente/producto
+        # (esos se buscan aparte, una vez por cliente/producto, en cargar_atributos)
+        return [
+            {'$match': match},
+            {
+                '$project': {
+                    '_id': 0,
+                    'cliente_id': 1,
+                    'fecha': 1,
+                    'canal': 1,
+                    'items.producto_id': 1,
+                    'items.cantidad': 1,
+                    'items.precio_unit': 1
                 }
-                pipeline.insert(0, date_filter)  
-                print(f"Analizando órdenes posteriores al: {next_day}")
-            else:
-                print("Primera ejecución")
-            
-           
-            pipeline.extend([
-                {
-                    '$addFields': {
-                        'fecha_solo': {
+            },
+            {
+                '$unwind': '$items'
+            },
+            {
+                '$group': {
+                    '_id': {
+                        'cliente_id': '$cliente_id',
+                        'producto_id': '$items.producto_id',
+                        'fecha': {
                             '$dateToString': {
                                 'format': '%Y-%m-%d',
                                 'date': '$fecha'
                             }
                         },
-                        'total_item': {
-                            '$multiply': ['$items.precio_unit', '$items.cantidad']
-                        }
-                    }
-                },
-                {
-                    '$group': {
-                        '_id': {
-                            'cliente_id': '$cliente_data._id',
-                            'producto_id': '$producto_data._id',
-                            'fecha': '$fecha_solo',
-                            'canal': '$canal'
-                        },
-                        'cliente_data': {'$first': '$cliente_data'},
-                        'producto_data': {'$first': '$producto_data'},
-                        'fecha_original': {'$first': '$fecha'},
-                        'canal': {'$first': '$canal'},
-                        'cantidad_total': {'$sum': '$items.cantidad'},
-                        'precio_unit_promedio': {'$avg': '$items.precio_unit'},
-                        'total_ventas_crc': {'$sum': '$total_item'}
+                        'canal': '$canal'
+                    },
+                    'fecha_original': {'$first': '$fecha'},
+                    'cantidad_total': {'$sum': '$items.cantidad'},
+                    'precio_unit_promedio': {'$avg': '$items.precio_unit'},
+                    'total_ventas_crc': {
+                        '$sum': {'$multiply': ['$items.precio_unit', '$items.cantidad']}
                     }
                 }
-            ])
+            }
+        ]
+    
+    def obtener_marca_baja(self, ordenes_collection):
+        orden = ordenes_collection.find_one(
+            {},
+            {'fecha': 1},
+            sort=[('fecha', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+        )
+        return orden['fecha']
+    
+    def rangos_fechas(self, desde, hasta, dias):
+        # cortes en días completos [inicio, fin): como el $group es por día, ningún grupo queda en dos shards
+        inicio = datetime.combine(desde.date(), datetime.min.time())
+        final = datetime.combine(hasta.date(), datetime.min.time()) + timedelta(days=1)
+        rangos = []
+        while inicio < final:
+            fin = min(inicio + timedelta(days=dias), final)
+            rangos.append((inicio, fin))
+            inicio = fin
+        return rangos
+    
+    def agregar_shard(self, ordenes_collection, filtro, rango):
+        inicio, fin = rango
+        match = {'$and': [filtro, {'fecha': {'$gte': inicio, '$lt': fin}}]}
+        cursor = ordenes_collection.aggregate(
+            self.pipeline_ventas(match),
+            allowDiskUse=True,
+            batchSize=self.batch_size
+        )
+        try:
+            return list(cursor)
+        finally:
+            cursor.close()
+    
+    def agregar_por_shards(self, ordenes_collection, filtro, desde, hasta, dias, hilos):
+        # cada shard corre su propio aggregate en un hilo (pymongo comparte el pool de conexiones)
+        # se devuelven en orden y solo hay "hilos" shards adelantados a la vez, para no llenar la memoria
+        rangos = iter(self.rangos_fechas(desde, hasta, dias))
+        with ThreadPoolExecutor(max_workers=hilos) as executor:
+            pendientes = deque(
+                executor.submit(self.agregar_shard, ordenes_collection, filtro, rango)
+                for rango in islice(rangos, hilos)
+            )
+            while pendientes:
+                ventas = pendientes.popleft().result()
+                siguiente = next(rangos, None)
+                if siguiente:
+                    pendientes.append(executor.submit(self.agregar_shard, ordenes_collection, filtro, siguiente))
+                yield from ventas
+    
+    def procesar_ordenes(self, limit=None, hilos=None, shard_dias=None):
+        if hilos is None:
+            hilos = self.hilos
+        if shard_dias is None:
+            shard_dias = self.shard_dias
+        
+        try:
             
-            if limit:
-                pipeline.append({'$limit': limit})
+            self.asegurar_tabla_estado()
+            
+            # el modo continuo también suma a FactVentas: con su resume token activo, el batch
+            # volvería a cargar órdenes que el stream ya aplicó
+            if self.leer_estado('resume_token'):
+                raise RuntimeError(
+                    "El modo continuo tiene un resume token activo; "
+                    "detener el stream y correr 'python etl.py --terminar-stream' antes del modo batch"
+                )
             
-            ventas_agregadas = list(ordenes_collection.aggregate(pipeline))
+            ordenes_collection = self.mongo_db['ordenes']
+            
+            # índice para que el filtro por (fecha, _id) sea un recorrido por rango
+            ordenes_collection.create_index([('fecha', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
             
-            if not ventas_agregadas:
+            # límite superior fijo: las órdenes que entren mientras corre el ETL quedan para la próxima
+            marca_alta = self.obtener_marca_alta(ordenes_collection)
+            if not marca_alta:
                 return 0, None
             
-           
+            # para no meter repetidos!!!! (se sigue exactamente desde la última orden cargada)
+            marca_agua = self.leer_marca_agua()
+            if marca_agua:
+                print(f"Analizando órdenes posteriores a: {marca_agua[0]} ({marca_agua[1]})")
+            else:
+                print("Primera ejecución")
             
+            self.cargar_dim_tiempo(marca_agua[0].date() if marca_agua else None)
+            
+            filtro = self.filtro_extraccion(marca_agua, marca_alta)
+            
+            if hilos > 1 and not limit:
+                # la ventana se parte en shards de shard_dias días que se agregan en paralelo
+                desde = marca_agua[0] if marca_agua else self.obtener_marca_baja(ordenes_collection)
+                print(f"Agregando en {hilos} hilos con shards de {shard_dias} días")
+                ventas_cursor = self.agregar_por_shards(ordenes_collection, filtro, desde, marca_alta[0], shard_dias, hilos)
+            else:
+                pipeline = self.pipeline_ventas(filtro)
+                
+                if limit:
+                    pipeline.append({'$limit': limit})
+                
+                # el resultado se lee del cursor por lotes (no se carga todo en memoria)
+                # y allowDiskUse deja que el $group use disco si pasa el límite de 100MB
+                ventas_cursor = ordenes_collection.aggregate(
+                    pipeline,
+                    allowDiskUse=True,
+                    batchSize=self.batch_size
+                )
+            
+            extracted_count = 0
             processed_count = 0
             error_count = 0
-            ultima_fecha_procesada = None
-            
-            for venta in ventas_agregadas:
-                try:
-                    
-                    fecha = venta['fecha_original']
-                    cantidad_total = venta['cantidad_total']
-                    total_crc = venta['total_ventas_crc']
-                    precio_unit_crc = venta['precio_unit_promedio'] 
-                    canal = venta['canal']
-                    
-                    
-                    if not ultima_fecha_procesada or fecha.date() > ultima_fecha_procesada:
-                        ultima_fecha_procesada = fecha.date()
-                    
-                    
-                    cliente_id = self.obtener_cliente(venta['cliente_data'])
-                    if not cliente_id:
-                        error_count += 1
-                        continue
-                    
-             
-                    producto_id = self.obtener_producto(venta['producto_data'])
-                    if not producto_id:
-                        error_count += 1
-                        continue
-                    
-                   
-                    canal_id = self.obtener_canal(canal)
-                    if not canal_id:
-                        error_count += 1
-                        continue
-                    
-               
-                    tiempo_id = self.get_tiempo_id(fecha)
-                    if not tiempo_id:
-                        error_count += 1
-                        continue
-                    
-                  
-                    tipo_cambio = self.tc_dia(fecha)
-                    precio_unit_usd = precio_unit_crc / tipo_cambio
-                    total_usd = total_crc / tipo_cambio
-                    
-                    
+            for lote in self.leer_lotes(ventas_cursor, self.batch_size):
+                extracted_count += len(lote)
+                filas, errores = self.transformar_lote(lote)
+                error_count += errores
+                
+                # el lote se suma a FactVentas de una vez; el commit se hace al final junto con la marca
+                # de agua, así si algo falla no queda nada a medias y la próxima ejecución repite todo
+                if filas:
                     cursor = self.sql_connection.cursor()
-                    insert_query = """
-                        INSERT INTO FactVentas (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    """
-                    
-                    cursor.execute(insert_query, (
-                        tiempo_id,
-                        producto_id,
-                        cliente_id,
-                        canal_id,
-                        round(total_usd, 2),
-                        cantidad_total,
-                        round(precio_unit_usd, 2)
-                    ))
-                    
-                    processed_count += 1
-                    
-                    if processed_count % 50 == 0:
-                        self.sql_connection.commit()
-                        
+                    processed_count += self.upsert_hechos(cursor, filas)
+                    cursor.close()
                 
-                except Exception as e:
-                    print(f"Error procesando venta agregada: {e}")
-                    error_count += 1
-                    continue
+                print(f"Procesados {processed_count} registros ({extracted_count} leídos de MongoDB)...")
             
-           
-            self.sql_connection.commit()
+            if extracted_count == 0:
+                return 0, None
             
+            if limit:
+                # el MERGE suma: confirmar sin mover la marca de agua haría que la próxima ejecución
+                # vuelva a sumar las mismas órdenes, así que con límite es solo una prueba
+                print("Ejecución con límite: se deshacen los cambios en el DW")
+                self.sql_connection.rollback()
+            else:
+                cursor = self.sql_connection.cursor()
+                self.guardar_estado(cursor, 'watermark', json_util.dumps({'fecha': marca_alta[0], 'id': marca_alta[1]}))
+                cursor.close()
+                self.sql_connection.commit()
             
             print(f"Errores: {error_count}")
             
-            return processed_count, ultima_fecha_procesada
+            if self.fechas_faltantes:
+                faltantes = sorted(self.fechas_faltantes)
+                print(f"Fechas sin registro en DimTiempo: {len(faltantes)} (ej: {', '.join(str(f) for f in faltantes[:10])})")
+            
+            return processed_count, marca_alta
             
         except Exception as e:
             print(f"Error en procesar_ordenes: {e}")
+            self.sql_connection.rollback()
+            raise
+    
+    def asegurar_tabla_estado(self):
+        # tabla del DW donde el ETL guarda su estado (resume token del change stream, etc.)
+        # se escribe en la misma transacción que los hechos
+        cursor = self.sql_connection.cursor()
+        cursor.execute("""
+            IF OBJECT_ID('dbo.EtlEstadoMongo') IS NULL
+                CREATE TABLE EtlEstadoMongo (
+                    Clave VARCHAR(50) PRIMARY KEY,
+                    Valor NVARCHAR(MAX) NULL,
+                    Actualizado DATETIME2 NOT NULL DEFAULT SYSDATETIME()
+                )
+        """)
+        # DW creado antes de la columna Fuente (ver dw/MigracionFuenteFactVentas.sql)
+        cursor.execute("""
+            IF COL_LENGTH('dbo.FactVentas', 'Fuente') IS NULL
+                ALTER TABLE FactVentas ADD Fuente VARCHAR(20) NULL
+        """)
+        self.sql_connection.commit()
+        cursor.close()
+    
+    def leer_estado(self, clave):
+        cursor = self.sql_connection.cursor()
+        cursor.execute("SELECT Valor FROM EtlEstadoMongo WHERE Clave = ?", clave)
+        result = cursor.fetchone()
+        cursor.close()
+        return result[0] if result else None
+    
+    def guardar_estado(self, cursor, clave, valor):
+        # no hace commit: lo hace quien llama, junto con los hechos
+        cursor.execute("""
+            MERGE EtlEstadoMongo AS e
+            USING (SELECT ? AS Clave, ? AS Valor) AS s
+                ON e.Clave = s.Clave
+            WHEN MATCHED THEN
+                UPDATE SET Valor = s.Valor, Actualizado = SYSDATETIME()
+            WHEN NOT MATCHED THEN
+                INSERT (Clave, Valor) VALUES (s.Clave, s.Valor);
+        """, (clave, valor))
+    
+    def agregar_deltas(self, ordenes):
+        # agrupa las órdenes nuevas igual que el $group del modo batch: (cliente, producto, fecha, canal)
+        grupos = {}
+        for orden in ordenes:
+            fecha = orden['fecha']
+            for item in orden.get('items', []):
+                clave = (orden['cliente_id'], item['producto_id'], fecha.strftime('%Y-%m-%d'), orden['canal'])
+                grupo = grupos.get(clave)
+                if grupo is None:
+                    grupo = grupos[clave] = {
+                        '_id': {
+                            'cliente_id': clave[0],
+                            'producto_id': clave[1],
+                            'fecha': clave[2],
+                            'canal': clave[3]
+                        },
+                        'fecha_original': fecha,
+                        'cantidad_total': 0,
+                        'total_ventas_crc': 0,
+                        'suma_precios': 0,
+                        'items': 0
+                    }
+                grupo['cantidad_total'] += item['cantidad']
+                grupo['total_ventas_crc'] += item['precio_unit'] * item['cantidad']
+                grupo['suma_precios'] += item['precio_unit']
+                grupo['items'] += 1
+        
+        ventas = []
+        for grupo in grupos.values():
+            grupo['precio_unit_promedio'] = grupo.pop('suma_precios') / grupo.pop('items')
+            ventas.append(grupo)
+        return ventas
+    
+    def upsert_hechos(self, cursor, filas):
+        # suma los deltas a FactVentas (o inserta si la combinación no existe), sin commit
+        # solo se tocan filas con Fuente = MONGODB: los hechos de los otros ETL no se suman
+        cursor.fast_executemany = True
+        cursor.execute("""
+            IF OBJECT_ID('tempdb..#StageFactVentas') IS NULL
+                CREATE TABLE #StageFactVentas (
+                    IdTiempo INT NOT NULL,
+                    IdProducto INT NOT NULL,
+                    IdCliente INT NOT NULL,
+                    IdCanal INT NOT NULL,
+                    TotalVentas DECIMAL(18,2),
+                    Cantidad INT,
+                    Precio DECIMAL(18,2)
+                )
+        """)
+        cursor.execute("TRUNCATE TABLE #StageFactVentas")
+        cursor.executemany("""
+            INSERT INTO #StageFactVentas (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, filas)
+        
+        # el precio siempre es el promedio ponderado (total / cantidad), llegue la venta en uno o varios lotes
+        cursor.execute("""
+            MERGE FactVentas AS fv
+            USING #StageFactVentas AS s
+                ON fv.IdTiempo = s.IdTiempo
+               AND fv.IdProducto = s.IdProducto
+               AND fv.IdCliente = s.IdCliente
+               AND fv.IdCanal = s.IdCanal
+               AND fv.Fuente = ?
+            WHEN MATCHED THEN
+                UPDATE SET TotalVentas = fv.TotalVentas + s.TotalVentas,
+                           Cantidad = fv.Cantidad + s.Cantidad,
+                           Precio = (fv.TotalVentas + s.TotalVentas) / NULLIF(fv.Cantidad + s.Cantidad, 0)
+            WHEN NOT MATCHED BY TARGET THEN
+                INSERT (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio, Fuente)
+                VALUES (s.IdTiempo, s.IdProducto, s.IdCliente, s.IdCanal, s.TotalVentas, s.Cantidad,
+                        s.TotalVentas / NULLIF(s.Cantidad, 0), ?);
+        """, (self.fuente, self.fuente))
+        return cursor.rowcount
+    
+    def aplicar_micro_lote(self, ordenes, resume_token):
+        # el stream arranca un poco antes de la marca alta de la puesta al día: lo que ya cargó el batch se descarta
+        if self.marca_puesta_al_dia:
+            ordenes = [
+                orden for orden in ordenes
+                if self.marca_mayor((orden['fecha'], orden['_id']), self.marca_puesta_al_dia)
+            ]
+        
+        if not ordenes:
+            try:
+                cursor = self.sql_connection.cursor()
+                self.guardar_estado(cursor, 'resume_token', json_util.dumps(resume_token))
+                self.sql_connection.commit()
+                cursor.close()
+            except Exception as e:
+                print(f"Error guardando resume token: {e}")
+                self.sql_connection.rollback()
+                raise
+            return
+        
+        ventas = self.agregar_deltas(ordenes)
+        
+        # si llegan fechas nuevas (cambio de día) se recarga DimTiempo
+        fechas = [venta['fecha_original'].date() for venta in ventas]
+        if fechas and any(fecha not in self.mapa_tiempo for fecha in fechas):
+            self.cargar_dim_tiempo(min(fechas))
+        
+        filas, errores = self.transformar_lote(ventas)
+        
+        # la marca de agua del batch también avanza con lo que aplica el stream
+        marca = max((orden['fecha'], orden['_id']) for orden in ordenes)
+        avanza = self.marca_mayor(marca, self.marca_stream)
+        
+        # hechos + resume token + marca de agua en la misma transacción: si se cae antes del commit,
+        # al reiniciar se vuelve a leer desde el token anterior y no se duplica nada
+        try:
+            cursor = self.sql_connection.cursor()
+            afectados = self.upsert_hechos(cursor, filas) if filas else 0
+            self.guardar_estado(cursor, 'resume_token', json_util.dumps(resume_token))
+            if avanza:
+                self.guardar_estado(cursor, 'watermark', json_util.dumps({'fecha': marca[0], 'id': marca[1]}))
+            self.sql_connection.commit()
+            cursor.close()
+        except Exception as e:
+            print(f"Error aplicando micro-lote: {e}")
+            self.sql_connection.rollback()
             raise
+        
+        if avanza:
+            self.marca_stream = marca
+        
+        print(f"Micro-lote: {len(ordenes)} órdenes, {len(ventas)} ventas agregadas, {afectados} filas en FactVentas, {errores} errores")
     
-    def run_etl(self, limit=None):
-        processed_count = 0
-        ultima_fecha_procesada = None
+    def escuchar_cambios(self, intervalo=None, max_eventos=None):
+        # modo continuo: sigue las inserciones en 'ordenes' con un change stream (requiere replica set)
+        if intervalo is None:
+            intervalo = self.stream_intervalo
+        if max_eventos is None:
+            max_eventos = self.stream_max_eventos
         
+        self.asegurar_tabla_estado()
+        
+        token = self.leer_estado('resume_token')
+        resume_after = json_util.loads(token) if token else None
+        inicio_stream = None
+        self.marca_puesta_al_dia = None
+        if resume_after:
+            # los eventos pendientes pueden ser de días anteriores
+            print("Continuando el change stream desde el último resume token")
+            self.cargar_dim_tiempo()
+        else:
+            # sin token, lo insertado desde la última ejecución batch no saldría en el stream:
+            # se toma el tiempo de operación del servidor, se pone al día con el modo batch hasta la
+            # marca alta y el stream arranca desde ese tiempo (lo que se cruce lo filtra aplicar_micro_lote)
+            with self.mongo_client.start_session() as sesion:
+                self.mongo_db.command('ping', session=sesion)
+                inicio_stream = sesion.operation_time
+            
+            print("Sin resume token: poniendo al día con el modo batch antes de abrir el stream")
+            self.procesar_ordenes()
+            self.marca_puesta_al_dia = self.leer_marca_agua()
+            self.cargar_dim_tiempo(datetime.now().date() - timedelta(days=1))
+        
+        self.marca_stream = self.leer_marca_agua()
+        
+        pipeline = [{'$match': {'operationType': 'insert'}}]
+        ordenes = []
+        inicio_lote = None
+        
+        with self.mongo_db['ordenes'].watch(
+            pipeline,
+            resume_after=resume_after,
+            start_at_operation_time=inicio_stream,
+            max_await_time_ms=1000
+        ) as stream:
+            try:
+                while stream.alive:
+                    cambio = stream.try_next()
+                    if cambio is not None:
+                        ordenes.append(cambio['fullDocument'])
+                        if inicio_lote is None:
+                            inicio_lote = time.monotonic()
+                    
+                    if ordenes and (len(ordenes) >= max_eventos or time.monotonic() - inicio_lote >= intervalo):
+                        self.aplicar_micro_lote(ordenes, stream.resume_token)
+                        ordenes = []
+                        inicio_lote = None
+                        
+            except KeyboardInterrupt:
+                print("Deteniendo change stream...")
+                if ordenes:
+                    self.aplicar_micro_lote(ordenes, stream.resume_token)
+    
+    def terminar_stream(self):
+        # vuelve al modo batch: se borra el resume token y el batch sigue desde la marca de agua,
+        # que el stream fue avanzando con cada micro-lote
+        try:
+            self.connect_sql_server()
+            self.asegurar_tabla_estado()
+            
+            cursor = self.sql_connection.cursor()
+            cursor.execute("DELETE FROM EtlEstadoMongo WHERE Clave = 'resume_token'")
+            self.sql_connection.commit()
+            cursor.close()
+            
+            marca = self.leer_marca_agua()
+            if marca:
+                print(f"Resume token borrado; el modo batch sigue desde {marca[0]} ({marca[1]})")
+            else:
+                print("Resume token borrado")
+        finally:
+            if self.sql_connection:
+                self.sql_connection.close()
+    
+    def run_stream(self, intervalo=None, max_eventos=None):
+        try:
+            print("Iniciando ETL MongoDB -> DW (change stream)")
+            
+            self.connect_mongo()
+            self.connect_sql_server()
+            
+            self.cargar_skus_existentes()
+            
+            try:
+                self.escuchar_cambios(intervalo, max_eventos)
+            finally:
+                self.asignador_sku.guardar()
+            
+        except Exception as e:
+            print(f"Error en ETL: {e}")
+            raise
+        finally:
+            
+            if self.mongo_client:
+                self.mongo_client.close()
+                print("Conexión MongoDB cerrada")
+            
+            if self.sql_connection:
+                self.sql_connection.close()
+                print("Conexión SQL Server cerrada")
+    
+    def run_etl(self, limit=None, hilos=None, shard_dias=None):
         try:
             print("Iniciando ETL MongoDB -> DW")
         
@@ -549,11 +1112,11 @@ class MongoToDW_ETL:
             self.cargar_skus_existentes()
             
             
-            processed_count, ultima_fecha_procesada = self.procesar_ordenes(limit)
+            processed_count, marca_alta = self.procesar_ordenes(limit, hilos, shard_dias)
+            self.asignador_sku.guardar()
             
             if processed_count > 0:
-                self.registrar_log(ultima_fecha_procesada)
-                print(f"ETL completado exitosamente - {processed_count} registros procesados")
+                print(f"ETL completado exitosamente - {processed_count} registros procesados (hasta {marca_alta[0]})")
             else:
                 print("No hay datos nuevos para procesar")
             
@@ -573,28 +1136,45 @@ class MongoToDW_ETL:
  
     def cargar_skus_existentes(self):
         
+        # primero lo que ya se había asignado, después se marcan en el bitmap los skus del DW
+        self.asignador_sku.cargar()
+        
         try:
             cursor = self.sql_connection.cursor()
-            cursor.execute("SELECT SKU FROM DimProducto")
-            skus_existentes = cursor.fetchall()
+            cursor.execute("""
+                SELECT SKU FROM DimProducto WHERE SKU LIKE 'SKU-%'
+                UNION
+                SELECT SKU FROM Equivalencias WHERE SKU LIKE 'SKU-%'
+            """)
             
-            for sku_row in skus_existentes:
-                if sku_row[0]:
-                    self.skus_generados.add(sku_row[0])
-            
-            
-            cursor.execute("SELECT SKU FROM Equivalencias WHERE SKU IS NOT NULL")
-            skus_equivalencias = cursor.fetchall()
-            
-            for sku_row in skus_equivalencias:
-                if sku_row[0]:
-                    self.skus_generados.add(sku_row[0])
+            for sku_row in cursor:
+                self.asignador_sku.marcar(sku_row[0])
             
             
         except Exception as e:
             print(f"Error cargando SKUs existentes: {e}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ETL MongoDB -> Data Warehouse (DW_VENTAS)')
+    parser.add_argument('--hilos', type=int, default=None,
+                        help='Hilos para agregar en paralelo por shards de fechas (default: ETL_HILOS o 1)')
+    parser.add_argument('--shard-dias', type=int, default=None,
+                        help='Días por shard en la agregación paralela (default: ETL_SHARD_DIAS o 30)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Modo continuo: escucha las órdenes nuevas con un change stream')
+    parser.add_argument('--intervalo', type=float, default=None,
+                        help='Segundos máximos por micro-lote en modo stream (default: ETL_STREAM_INTERVALO o 5)')
+    parser.add_argument('--max-eventos', type=int, default=None,
+                        help='Órdenes máximas por micro-lote en modo stream (default: ETL_STREAM_MAX_EVENTOS o 500)')
+    parser.add_argument('--terminar-stream', action='store_true',
+                        help='Borra el resume token del modo continuo para volver al modo batch')
+    args = parser.parse_args()
+    
     etl = MongoToDW_ETL()
     
-    etl.run_etl()
+    if args.terminar_stream:
+        etl.terminar_stream()
+    elif args.stream:
+        etl.run_stream(args.intervalo, args.max_eventos)
+    else:
+        etl.run_etl(hilos=args.hilos, shard_dias=args.shard_dias)
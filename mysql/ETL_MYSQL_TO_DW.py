@@ -10,12 +10,25 @@ Basado en la estructura del ETL de SQL Server
 import pyodbc
 import mysql.connector
 import logging
+import argparse
+import json
+import time
+from bisect import bisect_right
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from datetime import datetime
 from decimal import Decimal
 import platform
 import os
+import sys
 from dotenv import load_dotenv
 
+# Utilidades compartidas del DW (dw/datoscomunes)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dw', 'datoscomunes'))
+from calendario import asegurar_dim_tiempo
+from metricas import get_peak_rss_mb
+
 # Cargar variables de entorno desde el archivo env.txt
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), 'env.txt'))
 
@@ -57,22 +70,49 @@ class MySQLToDW_ETL:
             'X': 'X'
         }
         
-        # Sistema de origen para logging
+        # Sistema de origen para logging y columna Fuente de FactVentas
         self.source_system = 'MYSQL'
         
         # Tipo de cambio por defecto CRC→USD si no se encuentra en la tabla
         self.default_crc_to_usd_rate = 0.0019  # ~520 CRC por USD
+        self.default_crc_to_usd_decimal = Decimal(str(self.default_crc_to_usd_rate))
+        
+        # Tipos de cambio de DimTiempo en memoria (fechas ordenadas + tasas) para la ventana
+        self.rate_dates = []
+        self.rate_values = []
+        self.exchange_rate_forward_filled = 0
+        self.exchange_rate_fallbacks = 0
+        
+        # Tamaño de bloque para leer el resultado en streaming desde MySQL
+        self.fetch_size = int(os.getenv("ETL_FETCH_SIZE", "5000"))
+        
+        # Segundos que MySQL espera a que se lea el siguiente bloque del cursor sin buffer
+        # (entre bloques pasan las consultas al DW de todo el bloque anterior)
+        self.net_write_timeout = int(os.getenv("ETL_NET_WRITE_TIMEOUT", "3600"))
+        
+        # Tamaño de lote de la etapa de normalización de precios
+        self.normalize_batch_size = int(os.getenv("ETL_NORMALIZE_BATCH_SIZE", "10000"))
+        
+        # Procesos para la carga en paralelo por shards de cliente (1 = secuencial)
+        self.workers = int(os.getenv("ETL_WORKERS", "1"))
+        
+        # Marca de agua de la carga incremental (última Orden.id y fecha procesadas)
+        self.watermark_path = os.path.join(os.path.dirname(__file__), 'etl_watermark.json')
+    
+    def open_mysql_connection(self):
+        """Abre una conexión nueva a la base MySQL origen (sales_mysql)"""
+        return mysql.connector.connect(
+            host=self.mysql_host,
+            port=self.mysql_port,
+            user=self.mysql_user,
+            password=self.mysql_password,
+            database=self.mysql_database
+        )
     
     def connect_mysql(self):
         """Conecta a la base de datos MySQL origen (sales_mysql)"""
         try:
-            self.mysql_connection = mysql.connector.connect(
-                host=self.mysql_host,
-                port=self.mysql_port,
-                user=self.mysql_user,
-                password=self.mysql_password,
-                database=self.mysql_database
-            )
+            self.mysql_connection = self.open_mysql_connection()
             logging.info(f"Conexión exitosa a MySQL origen: {self.mysql_database}")
         except Exception as e:
             logging.error(f"Error conectando a MySQL origen: {e}")
@@ -105,6 +145,19 @@ class MySQLToDW_ETL:
             logging.error(f"Error conectando a Data Warehouse: {e}")
             raise
     
+    def ensure_fuente_column(self):
+        """
+        Agrega la columna FactVentas.Fuente si el DW se creó antes de ella
+        (ver dw/MigracionFuenteFactVentas.sql).
+        """
+        cursor = self.dw_connection.cursor()
+        cursor.execute("""
+            IF COL_LENGTH('dbo.FactVentas', 'Fuente') IS NULL
+                ALTER TABLE FactVentas ADD Fuente VARCHAR(20) NULL
+        """)
+        self.dw_connection.commit()
+        cursor.close()
+    
     def check_if_processed(self, source_key, table_name):
         """
         Verifica si un registro ya fue procesado.
@@ -155,32 +208,189 @@ class MySQLToDW_ETL:
         except:
             return Decimal('0.00')
     
-    def get_exchange_rate(self, fecha, moneda_origen='CRC', moneda_destino='USD'):
+    def clean_numbers(self, values):
         """
-        Obtiene el tipo de cambio para una fecha específica desde DimTiempo.
-        Si la moneda origen ya es USD, retorna 1.0
+        Limpia un lote de números en texto con las mismas reglas de clean_number.
+        Los precios se repiten mucho dentro de un lote: cada texto distinto se limpia
+        una sola vez y el resultado se reparte al resto del lote.
         """
-        if moneda_origen == 'USD':
-            return Decimal('1.0')
+        values = list(values)
+        clean = self.clean_number
+        limpios = {value: clean(value) for value in set(values)}
+        return [limpios[value] for value in values]
+    
+    def ensure_precio_normalizado(self):
+        """
+        Crea la columna numérica OrdenDetalle.precio_unit_num y el trigger que la vuelve a
+        NULL cuando cambia precio_unit, si la base aún no los tiene
+        (ver MigracionPrecioNormalizado.sql).
+        """
+        cursor = self.mysql_connection.cursor()
+        try:
+            cursor.execute("""
+                SELECT COUNT(*)
+                FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE()
+                  AND TABLE_NAME = 'OrdenDetalle'
+                  AND COLUMN_NAME = 'precio_unit_num'
+            """)
+            if cursor.fetchone()[0] == 0:
+                logging.info("Creando columna OrdenDetalle.precio_unit_num")
+                cursor.execute("ALTER TABLE OrdenDetalle ADD COLUMN precio_unit_num DECIMAL(18,2) NULL")
+                cursor.execute("CREATE INDEX IX_Detalle_precio_num ON OrdenDetalle(precio_unit_num)")
+            
+            # Sin el trigger, un precio corregido en el origen nunca se vuelve a normalizar
+            cursor.execute("""
+                SELECT COUNT(*)
+                FROM information_schema.TRIGGERS
+                WHERE TRIGGER_SCHEMA = DATABASE()
+                  AND TRIGGER_NAME = 'TR_OrdenDetalle_precio_pendiente'
+            """)
+            if cursor.fetchone()[0] == 0:
+                logging.info("Creando trigger TR_OrdenDetalle_precio_pendiente")
+                cursor.execute("""
+                    CREATE TRIGGER TR_OrdenDetalle_precio_pendiente
+                    BEFORE UPDATE ON OrdenDetalle
+                    FOR EACH ROW
+                    BEGIN
+                        IF NEW.precio_unit <> OLD.precio_unit THEN
+                            SET NEW.precio_unit_num = NULL;
+                        END IF;
+                    END
+                """)
+        finally:
+            cursor.close()
+    
+    def normalize_prices(self, batch_size=None, max_orden_id=None):
+        """
+        Etapa de limpieza: llena OrdenDetalle.precio_unit_num para las filas pendientes
+        (NULL). Cada lote se limpia en Python con clean_numbers, se carga en una tabla
+        temporal y se aplica con un único UPDATE ... JOIN. La primera ejecución procesa
+        todo el histórico; las siguientes solo las filas nuevas o con precio modificado.
+        Con max_orden_id solo normaliza el detalle de órdenes hasta ese id (la marca alta
+        de la extracción).
+        Retorna la cantidad de filas normalizadas.
+        """
+        if batch_size is None:
+            batch_size = self.normalize_batch_size
+        
+        try:
+            self.ensure_precio_normalizado()
+            
+            cursor = self.mysql_connection.cursor()
+            cursor.execute("""
+                CREATE TEMPORARY TABLE IF NOT EXISTS tmp_precio_normalizado (
+                    id INT PRIMARY KEY,
+                    precio DECIMAL(18,2) NOT NULL
+                )
+            """)
+            
+            filtro_orden = ""
+            params_orden = ()
+            if max_orden_id is not None:
+                filtro_orden = " AND orden_id <= %s"
+                params_orden = (max_orden_id,)
+            
+            normalized = 0
+            last_id = 0
+            while True:
+                cursor.execute("""
+                    SELECT id, precio_unit
+                    FROM OrdenDetalle
+                    WHERE precio_unit_num IS NULL AND id > %s{filtro_orden}
+                    ORDER BY id
+                    LIMIT %s
+                """.format(filtro_orden=filtro_orden), (last_id,) + params_orden + (batch_size,))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                
+                ids = [row[0] for row in rows]
+                precios = self.clean_numbers(row[1] for row in rows)
+                
+                cursor.execute("DELETE FROM tmp_precio_normalizado")
+                cursor.executemany(
+                    "INSERT INTO tmp_precio_normalizado (id, precio) VALUES (%s, %s)",
+                    list(zip(ids, precios))
+                )
+                cursor.execute("""
+                    UPDATE OrdenDetalle od
+                    INNER JOIN tmp_precio_normalizado t ON t.id = od.id
+                    SET od.precio_unit_num = t.precio
+                """)
+                self.mysql_connection.commit()
+                
+                normalized += len(rows)
+                last_id = ids[-1]
+                logging.info(f"Precios normalizados: {normalized}...")
+            
+            cursor.execute("DROP TEMPORARY TABLE IF EXISTS tmp_precio_normalizado")
+            cursor.close()
+            
+            logging.info(f"Normalización de precios completada: {normalized} filas")
+            return normalized
+            
+        except Exception as e:
+            logging.error(f"Error normalizando precios: {e}")
+            self.mysql_connection.rollback()
+            raise
+    
+    def load_exchange_rates(self, fecha_min, fecha_max):
+        """
+        Carga una sola vez los tipos de cambio de DimTiempo para la ventana de fechas,
+        más la última tasa publicada antes de fecha_min (para arrastrarla hacia adelante).
+        """
+        self.rate_dates = []
+        self.rate_values = []
         
         try:
             cursor = self.dw_connection.cursor()
             
-            # Buscar tipo de cambio en DimTiempo para esa fecha
-            query = "SELECT TOP 1 TipoCambio FROM DimTiempo WHERE Fecha = ?"
-            cursor.execute(query, fecha)
+            cursor.execute("""
+                SELECT TOP 1 Fecha, TipoCambio FROM DimTiempo
+                WHERE Fecha < ? AND TipoCambio IS NOT NULL AND TipoCambio <> 0
+                ORDER BY Fecha DESC
+            """, fecha_min)
+            rows = cursor.fetchall()
             
-            result = cursor.fetchone()
-            if result and result[0]:
-                return Decimal(str(result[0]))
+            cursor.execute("""
+                SELECT Fecha, TipoCambio FROM DimTiempo
+                WHERE Fecha BETWEEN ? AND ? AND TipoCambio IS NOT NULL AND TipoCambio <> 0
+                ORDER BY Fecha
+            """, (fecha_min, fecha_max))
+            rows += cursor.fetchall()
+            
+            for fecha, tipo_cambio in rows:
+                # Puede haber más de un registro por fecha: se queda el primero
+                if self.rate_dates and self.rate_dates[-1] == fecha:
+                    continue
+                self.rate_dates.append(fecha)
+                self.rate_values.append(Decimal(str(tipo_cambio)))
             
-            # Si no hay tipo de cambio, usar valor por defecto
-            logging.warning(f"No se encontró tipo de cambio para {fecha}, usando tasa por defecto")
-            return Decimal(str(self.default_crc_to_usd_rate))
+            logging.info(f"Tipos de cambio en memoria: {len(self.rate_dates)} fechas ({fecha_min} a {fecha_max})")
             
         except Exception as e:
-            logging.error(f"Error obteniendo tipo de cambio: {e}")
-            return Decimal(str(self.default_crc_to_usd_rate))
+            logging.error(f"Error cargando tipos de cambio: {e}")
+    
+    def get_exchange_rate(self, fecha, moneda_origen='CRC', moneda_destino='USD'):
+        """
+        Obtiene el tipo de cambio para una fecha desde la tabla en memoria cargada con
+        load_exchange_rates. Si la fecha no tiene tasa publicada usa la última anterior;
+        si no hay ninguna, usa default_crc_to_usd_rate.
+        Si la moneda origen ya es USD, retorna 1.0
+        """
+        if moneda_origen == 'USD':
+            return Decimal('1.0')
+        
+        pos = bisect_right(self.rate_dates, fecha) - 1
+        if pos >= 0:
+            if self.rate_dates[pos] != fecha:
+                self.exchange_rate_forward_filled += 1
+            return self.rate_values[pos]
+        
+        # Si no hay tipo de cambio, usar valor por defecto
+        self.exchange_rate_fallbacks += 1
+        return self.default_crc_to_usd_decimal
     
     def get_or_create_cliente(self, cliente_data):
         """
@@ -341,8 +551,9 @@ class MySQLToDW_ETL:
             semana = fecha_obj.isocalendar()[1]
             dia_semana = fecha_obj.strftime('%A')
             
-            # Obtener tipo de cambio desde DimTiempo si existe, sino usar 1.0
-            tipo_cambio = 1.0
+            # Sin tipo de cambio (NULL): el job del BCCR lo completa y, mientras tanto,
+            # get_exchange_rate arrastra la última tasa publicada o usa la de defecto
+            tipo_cambio = None
             
             cursor.execute(insert_query, (
                 anio, mes, dia, fecha_buscar, semana, dia_semana, tipo_cambio
@@ -388,175 +599,479 @@ class MySQLToDW_ETL:
             logging.error(f"Error obteniendo/creando DimCanal: {e}")
             return None
     
-    def process_orders(self, limit=None):
+    def read_watermark(self):
+        """
+        Lee la marca de agua persistida (última Orden.id y su fecha ya cargadas).
+        Retorna (orden_id, fecha) o (None, None) si no hay ejecuciones previas.
+        """
+        try:
+            if not os.path.exists(self.watermark_path):
+                logging.info("No se encontró marca de agua previa, se hará una carga completa")
+                return None, None
+            
+            with open(self.watermark_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            
+            orden_id = int(data['orden_id'])
+            fecha = data.get('fecha')
+            logging.info(f"Marca de agua encontrada: OrdenId={orden_id}, Fecha={fecha}")
+            return orden_id, fecha
+            
+        except Exception as e:
+            logging.error(f"Error leyendo marca de agua: {e}")
+            return None, None
+    
+    def save_watermark(self, orden_id, fecha):
+        """
+        Persiste la marca de agua de forma atómica (archivo temporal + reemplazo).
+        """
+        try:
+            tmp_path = self.watermark_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'orden_id': int(orden_id), 'fecha': fecha}, f)
+            os.replace(tmp_path, self.watermark_path)
+            logging.info(f"Marca de agua actualizada: OrdenId={orden_id}, Fecha={fecha}")
+        except Exception as e:
+            logging.error(f"Error guardando marca de agua: {e}")
+    
+    def get_source_high_mark(self):
+        """
+        Retorna (id, fecha) de la última orden en sales_mysql, usada como límite superior
+        de la extracción. Retorna (None, None) si no hay órdenes.
+        """
+        cursor = self.mysql_connection.cursor()
+        try:
+            cursor.execute("SELECT id, fecha FROM Orden ORDER BY id DESC LIMIT 1")
+            result = cursor.fetchone()
+        finally:
+            cursor.close()
+        if not result:
+            return None, None
+        return result[0], result[1]
+    
+    def build_extraction_filter(self, high_mark, since=None, full_refresh=False):
+        """
+        Construye el filtro WHERE sobre Orden (alias o) para la extracción.
+        - full_refresh: sin límite inferior.
+        - since: órdenes desde esa fecha 'YYYY-MM-DD' (backfill), ignora la marca de agua.
+          Usa el índice IX_Orden_fecha (fecha es texto con formato ordenable).
+        - por defecto: órdenes con id mayor a la marca de agua (llave primaria).
+        Retorna (condiciones, parámetros).
+        """
+        conditions = []
+        params = []
+        
+        if full_refresh:
+            logging.info("Modo full refresh: se extraen todas las órdenes")
+        elif since is not None:
+            logging.info(f"Backfill desde {since}")
+            conditions.append("o.fecha >= %s")
+            params.append(since)
+        else:
+            last_orden_id, _ = self.read_watermark()
+            if last_orden_id is not None:
+                conditions.append("o.id > %s")
+                params.append(last_orden_id)
+        
+        # Límite superior fijo para no mezclar órdenes que lleguen durante la ejecución
+        high_orden_id, _ = high_mark
+        conditions.append("o.id <= %s")
+        params.append(high_orden_id)
+        
+        return conditions, params
+    
+    def get_source_date_window(self, conditions, params):
+        """
+        Retorna (fecha_min, fecha_max) de las órdenes que cumplen el filtro.
+        Retorna (None, None) si no hay órdenes.
+        """
+        cursor = self.mysql_connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT MIN(DATE(o.fecha)), MAX(DATE(o.fecha)) FROM Orden o WHERE " + " AND ".join(conditions),
+                params
+            )
+            result = cursor.fetchone()
+        finally:
+            cursor.close()
+        if not result:
+            return None, None
+        return result[0], result[1]
+    
+    def extract_ventas(self, query, params, fetch_size):
+        """
+        Generador de extracción en streaming: usa un cursor sin buffer, de modo que MySQL
+        envía el resultado a medida que se lee, y entrega bloques de fetch_size filas.
+        Las filas son tuplas con nombre; el mapeo de columnas se arma una sola vez.
+        El cursor va en una conexión propia: mientras está abierto esa conexión no sirve
+        para otras consultas, y la principal queda libre. Como cada bloque se carga al DW
+        antes de leer el siguiente, la sesión sube net_write_timeout (ETL_NET_WRITE_TIMEOUT)
+        para que MySQL no corte el envío en rangos grandes.
+        """
+        connection = self.open_mysql_connection()
+        cursor = connection.cursor(buffered=False)
+        try:
+            cursor.execute("SET SESSION net_write_timeout = %s", (self.net_write_timeout,))
+            cursor.execute(query, params)
+            Venta = namedtuple('Venta', cursor.column_names)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield [Venta._make(row) for row in rows]
+        finally:
+            cursor.close()
+            connection.close()
+    
+    def build_orders_query(self, conditions):
+        """
+        Query para obtener ventas agregadas por cliente/producto/fecha
+        filtrando las órdenes con las condiciones indicadas.
+        """
+        return """
+            SELECT 
+                c.id as cliente_id,
+                c.nombre,
+                c.correo,
+                c.genero,
+                c.pais,
+                c.created_at,
+                p.id as producto_id,
+                p.codigo_alt,
+                p.nombre as producto_nombre,
+                p.categoria,
+                DATE(o.fecha) as fecha,
+                o.canal,
+                o.moneda,
+                SUM(od.cantidad) as cantidad_total,
+                AVG(od.precio_unit_num) as precio_promedio,
+                SUM(od.cantidad * od.precio_unit_num) as total_ventas
+            FROM OrdenDetalle od
+            INNER JOIN Orden o ON od.orden_id = o.id
+            INNER JOIN Producto p ON od.producto_id = p.id
+            INNER JOIN Cliente c ON o.cliente_id = c.id
+            WHERE {filtro}
+            GROUP BY 
+                c.id, c.nombre, c.correo, c.genero, c.pais, c.created_at,
+                p.id, p.codigo_alt, p.nombre, p.categoria,
+                DATE(o.fecha), o.canal, o.moneda
+        """.format(filtro=" AND ".join(conditions))
+    
+    def process_orders(self, limit=None, fetch_size=None, since=None, full_refresh=False, workers=None):
         """
         Procesa las órdenes desde MySQL y las carga en FactVentas.
         Agrupa por cliente, producto y fecha para evitar duplicados.
+        El resultado agregado se lee en streaming por bloques de fetch_size.
+        Solo extrae órdenes posteriores a la marca de agua, salvo since/full_refresh.
+        Con workers > 1 la carga se reparte por cliente en procesos (process_orders_parallel).
         """
+        if fetch_size is None:
+            fetch_size = self.fetch_size
+        if workers is None:
+            workers = self.workers
+        
         try:
-            mysql_cursor = self.mysql_connection.cursor(dictionary=True)
-            
-            # Query para obtener ventas agregadas por cliente/producto/fecha
-            query = """
-                SELECT 
-                    c.id as cliente_id,
-                    c.nombre,
-                    c.correo,
-                    c.genero,
-                    c.pais,
-                    c.created_at,
-                    p.id as producto_id,
-                    p.codigo_alt,
-                    p.nombre as producto_nombre,
-                    p.categoria,
-                    DATE(o.fecha) as fecha,
-                    o.canal,
-                    o.moneda,
-                    SUM(od.cantidad) as cantidad_total,
-                    AVG(CAST(REPLACE(REPLACE(od.precio_unit, ',', ''), ' ', '') AS DECIMAL(18,2))) as precio_promedio,
-                    SUM(od.cantidad * CAST(REPLACE(REPLACE(od.precio_unit, ',', ''), ' ', '') AS DECIMAL(18,2))) as total_ventas
-                FROM OrdenDetalle od
-                INNER JOIN Orden o ON od.orden_id = o.id
-                INNER JOIN Producto p ON od.producto_id = p.id
-                INNER JOIN Cliente c ON o.cliente_id = c.id
-                GROUP BY 
-                    c.id, c.nombre, c.correo, c.genero, c.pais, c.created_at,
-                    p.id, p.codigo_alt, p.nombre, p.categoria,
-                    DATE(o.fecha), o.canal, o.moneda
-            """
+            high_mark = self.get_source_high_mark()
+            if high_mark[0] is None:
+                logging.info("No hay órdenes en el origen, nada que procesar")
+                return
             
-            if limit:
-                query += f" LIMIT {limit}"
+            # Normalizar precios pendientes después de fijar la marca alta y dentro de su
+            # ventana: el detalle que se extrae ya tiene precio_unit_num (SUM/AVG omiten NULL)
+            self.normalize_prices(max_orden_id=high_mark[0])
             
-            mysql_cursor.execute(query)
-            ventas = mysql_cursor.fetchall()
+            conditions, params = self.build_extraction_filter(high_mark, since, full_refresh)
+            self.ensure_fuente_column()
             
-            logging.info(f"Procesando {len(ventas)} registros agregados de ventas desde MySQL")
+            load_start = time.perf_counter()
             
-            processed_count = 0
-            error_count = 0
-            skipped_count = 0
+            if workers > 1 and not limit:
+                stats = self.process_orders_parallel(conditions, params, fetch_size, workers)
+            else:
+                stats = self.load_orders(conditions, params, fetch_size, limit)
             
-            for venta in ventas:
-                try:
-                    # Extraer datos del cliente
-                    cliente_data = {
-                        'nombre': venta['nombre'],
-                        'email': venta['correo'],
-                        'genero': venta['genero'],
-                        'pais': venta['pais'],
-                        'created_at': venta['created_at']
-                    }
-                    
-                    # Extraer datos del producto
-                    producto_data = {
-                        'codigo_alt': venta['codigo_alt'],
-                        'nombre': venta['producto_nombre'],
-                        'categoria': venta['categoria']
-                    }
-                    
-                    # Datos de la venta
-                    fecha = venta['fecha']
-                    canal = venta['canal']
-                    moneda = venta['moneda']
-                    cantidad_total = venta['cantidad_total']
-                    precio_promedio = Decimal(str(venta['precio_promedio']))
-                    total_ventas = Decimal(str(venta['total_ventas']))
-                    
-                    # Verificar si esta combinación ya fue procesada
-                    dw_cursor = self.dw_connection.cursor()
-                    check_query = """
-                        SELECT COUNT(*) 
-                        FROM FactVentas fv
-                        INNER JOIN DimCliente c ON fv.IdCliente = c.IdCliente
-                        INNER JOIN DimProducto p ON fv.IdProducto = p.IdProducto
-                        INNER JOIN DimTiempo t ON fv.IdTiempo = t.IdTiempo
-                        INNER JOIN Equivalencias e ON p.SKU = e.SKU
-                        WHERE c.Email = ? AND e.CodigoAlt = ? AND t.Fecha = ?
-                    """
-                    dw_cursor.execute(check_query, (cliente_data['email'], producto_data['codigo_alt'], fecha))
-                    count_result = dw_cursor.fetchone()
-                    
-                    if count_result and count_result[0] > 0:
-                        skipped_count += 1
-                        if skipped_count % 50 == 0:
-                            logging.info(f"Registros omitidos (ya procesados): {skipped_count}")
-                        continue
-                    
-                    # Procesar cliente
-                    cliente_id = self.get_or_create_cliente(cliente_data)
-                    if not cliente_id:
-                        error_count += 1
-                        continue
-                    
-                    # Procesar producto con equivalencias
-                    producto_id = self.process_equivalencias_and_get_producto(producto_data)
-                    if not producto_id:
-                        error_count += 1
-                        continue
-                    
-                    # Procesar tiempo
-                    tiempo_id = self.get_or_create_tiempo(fecha)
-                    if not tiempo_id:
-                        error_count += 1
-                        continue
-                    
-                    # Procesar canal
-                    canal_id = self.get_or_create_canal(canal)
-                    if not canal_id:
-                        error_count += 1
-                        continue
-                    
-                    # Convertir moneda si es necesario
-                    if moneda == 'CRC':
-                        tipo_cambio = self.get_exchange_rate(fecha, 'CRC', 'USD')
-                        precio_usd = precio_promedio * tipo_cambio
-                        total_usd = total_ventas * tipo_cambio
-                    else:
-                        precio_usd = precio_promedio
-                        total_usd = total_ventas
-                    
-                    # Insertar en FactVentas
-                    insert_cursor = self.dw_connection.cursor()
-                    insert_query = """
-                        INSERT INTO FactVentas (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    """
-                    
-                    insert_cursor.execute(insert_query, (
-                        tiempo_id,
-                        producto_id,
-                        cliente_id,
-                        canal_id,
-                        round(float(total_usd), 2),
-                        cantidad_total,
-                        round(float(precio_usd), 2)
-                    ))
-                    
-                    processed_count += 1
-                    
-                    if processed_count % 50 == 0:
-                        self.dw_connection.commit()
-                        logging.info(f"Procesados {processed_count} registros nuevos...")
-                
-                except Exception as e:
-                    logging.error(f"Error procesando venta: {e}")
-                    error_count += 1
-                    continue
+            if stats is None:
+                logging.info("No hay órdenes nuevas desde la última ejecución")
+                return
             
-            # Commit final
-            self.dw_connection.commit()
+            # Avanzar la marca de agua solo si se procesó la ventana completa
+            if limit:
+                logging.info("Ejecución con límite: no se actualiza la marca de agua")
+            elif stats['errores']:
+                logging.warning("Hubo errores: no se actualiza la marca de agua")
+            else:
+                self.save_watermark(*high_mark)
+            
+            elapsed = time.perf_counter() - load_start
+            rows_per_sec = stats['procesados'] / elapsed if elapsed > 0 else 0.0
+            peak_rss = get_peak_rss_mb()
             
             logging.info(f"ETL completado:")
-            logging.info(f"  - Registros procesados: {processed_count}")
-            logging.info(f"  - Registros omitidos (duplicados): {skipped_count}")
-            logging.info(f"  - Errores: {error_count}")
+            logging.info(f"  - Procesos: {workers if workers > 1 and not limit else 1}")
+            logging.info(f"  - Registros extraídos: {stats['extraidos']}")
+            logging.info(f"  - Registros procesados: {stats['procesados']}")
+            logging.info(f"  - Registros omitidos (duplicados): {stats['omitidos']}")
+            logging.info(f"  - Errores: {stats['errores']}")
+            logging.info(f"  - Tipo de cambio arrastrado de una fecha anterior: {stats['tipo_cambio_arrastrado']}")
+            logging.info(f"  - Tipo de cambio por defecto ({self.default_crc_to_usd_rate}): {stats['tipo_cambio_defecto']}")
+            logging.info(f"  - Tiempo: {elapsed:.2f}s ({rows_per_sec:.1f} registros/s)")
+            if peak_rss is not None:
+                # En modo paralelo es el pico del proceso coordinador
+                logging.info(f"  - Pico de memoria (RSS): {peak_rss:.1f} MB")
             
         except Exception as e:
             logging.error(f"Error en process_orders: {e}")
             raise
     
-    def run_etl(self, limit=None):
+    def prepare_shared_dimensions(self, conditions, params, fecha_min, fecha_max):
+        """
+        Crea antes de repartir el trabajo las dimensiones que comparten todos los shards:
+        clientes, productos/equivalencias, canales y fechas de la ventana. Los clientes
+        también se crean aquí, así los shards solo leen DimCliente.
+        Retorna los tipos de cambio de la ventana (fechas, tasas), leídos antes de crear
+        el calendario, para que los shards usen la misma tabla.
+        """
+        filtro = " AND ".join(conditions)
+        cursor = self.mysql_connection.cursor()
+        try:
+            cursor.execute("""
+                SELECT DISTINCT p.codigo_alt, p.nombre, p.categoria
+                FROM OrdenDetalle od
+                INNER JOIN Orden o ON od.orden_id = o.id
+                INNER JOIN Producto p ON od.producto_id = p.id
+                WHERE {filtro}
+            """.format(filtro=filtro), params)
+            productos = cursor.fetchall()
+            
+            cursor.execute("""
+                SELECT DISTINCT c.nombre, c.correo, c.genero, c.pais, c.created_at
+                FROM Orden o
+                INNER JOIN Cliente c ON o.cliente_id = c.id
+                WHERE {filtro}
+            """.format(filtro=filtro), params)
+            clientes = cursor.fetchall()
+            
+            cursor.execute("SELECT DISTINCT o.canal FROM Orden o WHERE " + filtro, params)
+            canales = [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        
+        for nombre, correo, genero, pais, created_at in clientes:
+            self.get_or_create_cliente({
+                'nombre': nombre,
+                'email': correo,
+                'genero': genero,
+                'pais': pais,
+                'created_at': created_at
+            })
+        
+        for codigo_alt, nombre, categoria in productos:
+            self.process_equivalencias_and_get_producto({
+                'codigo_alt': codigo_alt,
+                'nombre': nombre,
+                'categoria': categoria
+            })
+        
+        for canal in canales:
+            self.get_or_create_canal(canal)
+        
+        # Tipos de cambio antes del calendario: las fechas nuevas no son tasas publicadas
+        self.load_exchange_rates(fecha_min, fecha_max)
+        rates = (self.rate_dates, self.rate_values)
+        asegurar_dim_tiempo(self.dw_connection, fecha_min, fecha_max, tipo_cambio=None)
+        
+        logging.info(
+            f"Dimensiones compartidas listas: {len(clientes)} clientes, {len(productos)} productos, "
+            f"{len(canales)} canales"
+        )
+        return rates
+    
+    def process_orders_parallel(self, conditions, params, fetch_size, workers):
+        """
+        Reparte las ventas por MOD(CRC32(correo normalizado), workers) y carga cada shard en un
+        proceso con sus propias conexiones a MySQL y al DW (ver procesar_shard).
+        El correo es parte de la llave con la que load_orders descarta hechos ya cargados
+        (Email, CodigoAlt, Fecha): dos clientes del origen con el mismo correo caen en el
+        mismo shard, así la verificación y el INSERT de esa llave los hace un solo proceso.
+        Retorna las estadísticas sumadas de todos los shards, o None si no hay órdenes.
+        """
+        fecha_min, fecha_max = self.get_source_date_window(conditions, params)
+        if fecha_min is None:
+            return None
+        
+        rates = self.prepare_shared_dimensions(conditions, params, fecha_min, fecha_max)
+        
+        logging.info(f"Procesando ventas en {workers} procesos (shards por correo de cliente)")
+        
+        stats = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(procesar_shard, shard, workers, conditions, params, fetch_size, rates)
+                for shard in range(workers)
+            ]
+            for future in futures:
+                shard_stats = future.result()
+                if shard_stats is None:
+                    continue
+                for key, value in shard_stats.items():
+                    stats[key] = stats.get(key, 0) + value
+        
+        # Ningún shard tuvo ventas (por ejemplo, órdenes borradas durante la ejecución)
+        return stats or None
+    
+    def load_orders(self, conditions, params, fetch_size, limit=None, rates=None):
+        """
+        Extrae, transforma y carga en FactVentas las ventas que cumplen el filtro.
+        rates (fechas, tasas) reemplaza la lectura de tipos de cambio de la ventana
+        (los shards reciben la del coordinador).
+        Retorna un diccionario con los contadores de la carga, o None si no hay órdenes.
+        """
+        query = self.build_orders_query(conditions)
+        
+        if limit:
+            query += f" LIMIT {limit}"
+        
+        # Tipos de cambio de la ventana de fechas a procesar
+        fecha_min, fecha_max = self.get_source_date_window(conditions, params)
+        if fecha_min is None:
+            return None
+        if rates is None:
+            self.load_exchange_rates(fecha_min, fecha_max)
+        else:
+            self.rate_dates, self.rate_values = rates
+        
+        logging.info(f"Procesando ventas agregadas desde MySQL en bloques de {fetch_size} registros")
+        
+        extracted_count = 0
+        processed_count = 0
+        error_count = 0
+        skipped_count = 0
+        
+        ventas = chain.from_iterable(self.extract_ventas(query, params, fetch_size))
+        
+        for venta in ventas:
+            extracted_count += 1
+            try:
+                # Extraer datos del cliente
+                cliente_data = {
+                    'nombre': venta.nombre,
+                    'email': venta.correo,
+                    'genero': venta.genero,
+                    'pais': venta.pais,
+                    'created_at': venta.created_at
+                }
+                
+                # Extraer datos del producto
+                producto_data = {
+                    'codigo_alt': venta.codigo_alt,
+                    'nombre': venta.producto_nombre,
+                    'categoria': venta.categoria
+                }
+                
+                # Datos de la venta
+                fecha = venta.fecha
+                canal = venta.canal
+                moneda = venta.moneda
+                cantidad_total = venta.cantidad_total
+                precio_promedio = Decimal(str(venta.precio_promedio))
+                total_ventas = Decimal(str(venta.total_ventas))
+                
+                # Verificar si esta combinación ya fue procesada
+                dw_cursor = self.dw_connection.cursor()
+                check_query = """
+                    SELECT COUNT(*) 
+                    FROM FactVentas fv
+                    INNER JOIN DimCliente c ON fv.IdCliente = c.IdCliente
+                    INNER JOIN DimProducto p ON fv.IdProducto = p.IdProducto
+                    INNER JOIN DimTiempo t ON fv.IdTiempo = t.IdTiempo
+                    INNER JOIN Equivalencias e ON p.SKU = e.SKU
+                    WHERE c.Email = ? AND e.CodigoAlt = ? AND t.Fecha = ?
+                """
+                dw_cursor.execute(check_query, (cliente_data['email'], producto_data['codigo_alt'], fecha))
+                count_result = dw_cursor.fetchone()
+                
+                if count_result and count_result[0] > 0:
+                    skipped_count += 1
+                    if skipped_count % 50 == 0:
+                        logging.info(f"Registros omitidos (ya procesados): {skipped_count}")
+                    continue
+                
+                # Procesar cliente
+                cliente_id = self.get_or_create_cliente(cliente_data)
+                if not cliente_id:
+                    error_count += 1
+                    continue
+                
+                # Procesar producto con equivalencias
+                producto_id = self.process_equivalencias_and_get_producto(producto_data)
+                if not producto_id:
+                    error_count += 1
+                    continue
+                
+                # Procesar tiempo
+                tiempo_id = self.get_or_create_tiempo(fecha)
+                if not tiempo_id:
+                    error_count += 1
+                    continue
+                
+                # Procesar canal
+                canal_id = self.get_or_create_canal(canal)
+                if not canal_id:
+                    error_count += 1
+                    continue
+                
+                # Convertir moneda si es necesario
+                if moneda == 'CRC':
+                    tipo_cambio = self.get_exchange_rate(fecha, 'CRC', 'USD')
+                    precio_usd = precio_promedio * tipo_cambio
+                    total_usd = total_ventas * tipo_cambio
+                else:
+                    precio_usd = precio_promedio
+                    total_usd = total_ventas
+                
+                # Insertar en FactVentas
+                insert_cursor = self.dw_connection.cursor()
+                insert_query = """
+                    INSERT INTO FactVentas (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio, Fuente)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """
+                
+                insert_cursor.execute(insert_query, (
+                    tiempo_id,
+                    producto_id,
+                    cliente_id,
+                    canal_id,
+                    round(float(total_usd), 2),
+                    cantidad_total,
+                    round(float(precio_usd), 2),
+                    self.source_system
+                ))
+                
+                processed_count += 1
+                
+                if processed_count % 50 == 0:
+                    self.dw_connection.commit()
+                    logging.info(f"Procesados {processed_count} registros nuevos...")
+            
+            except Exception as e:
+                logging.error(f"Error procesando venta: {e}")
+                error_count += 1
+                continue
+        
+        # Commit final
+        self.dw_connection.commit()
+        
+        return {
+            'extraidos': extracted_count,
+            'procesados': processed_count,
+            'omitidos': skipped_count,
+            'errores': error_count,
+            'tipo_cambio_arrastrado': self.exchange_rate_forward_filled,
+            'tipo_cambio_defecto': self.exchange_rate_fallbacks
+        }
+    
+    def run_etl(self, limit=None, fetch_size=None, normalize_only=False, since=None, full_refresh=False,
+                workers=None):
         """Ejecuta el proceso completo de ETL"""
         try:
             logging.info("="*60)
@@ -567,8 +1082,14 @@ class MySQLToDW_ETL:
             self.connect_mysql()
             self.connect_dw()
             
+            # Solo normalizar precios; la carga normal los normaliza en process_orders
+            if normalize_only:
+                self.normalize_prices()
+                return
+            
             # Procesar órdenes
-            self.process_orders(limit)
+            self.process_orders(limit, fetch_size=fetch_size, since=since, full_refresh=full_refresh,
+                                workers=workers)
             
             logging.info("="*60)
             logging.info("ETL completado exitosamente")
@@ -588,7 +1109,50 @@ class MySQLToDW_ETL:
                 logging.info("Conexión Data Warehouse cerrada")
 
 
+def procesar_shard(shard, num_shards, conditions, params, fetch_size, rates=None):
+    """
+    Carga un shard de ventas (clientes con MOD(CRC32(correo normalizado), num_shards) = shard)
+    en un proceso aparte, con conexiones propias a MySQL y al DW. El correo se normaliza
+    igual que lo compara el DW (sin mayúsculas ni espacios); sin correo van todos al mismo shard.
+    rates son los tipos de cambio que leyó el coordinador antes de crear el calendario.
+    Debe ser una función de módulo para que ProcessPoolExecutor la pueda serializar.
+    """
+    etl = MySQLToDW_ETL()
+    try:
+        etl.connect_mysql()
+        etl.connect_dw()
+        logging.info(f"Shard {shard + 1}/{num_shards} iniciado")
+        stats = etl.load_orders(
+            conditions + ["MOD(CRC32(COALESCE(LOWER(TRIM(c.correo)), '')), %s) = %s"],
+            params + [num_shards, shard],
+            fetch_size,
+            rates=rates
+        )
+        logging.info(f"Shard {shard + 1}/{num_shards} completado: {stats}")
+        return stats
+    finally:
+        if etl.mysql_connection:
+            etl.mysql_connection.close()
+        if etl.dw_connection:
+            etl.dw_connection.close()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ETL MySQL (sales_mysql) -> Data Warehouse (DW_VENTAS)')
+    parser.add_argument('--limit', type=int, default=None, help='Máximo de registros agregados a procesar')
+    parser.add_argument('--fetch-size', type=int, default=None,
+                        help='Filas por bloque al leer MySQL en streaming (default: ETL_FETCH_SIZE o 5000)')
+    parser.add_argument('--normalize-only', action='store_true',
+                        help='Solo normalizar OrdenDetalle.precio_unit_num (carga inicial del histórico)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Procesos en paralelo, un shard de clientes por proceso (default: ETL_WORKERS o 1)')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='Ignorar la marca de agua y extraer todas las órdenes')
+    parser.add_argument('--since', type=str, default=None,
+                        help='Backfill: extraer órdenes desde esta fecha (YYYY-MM-DD), ignora la marca de agua')
+    args = parser.parse_args()
+    
     etl = MySQLToDW_ETL()
-    # Ejecutar sin límite para procesar todos los registros
-    etl.run_etl()
+    # Sin --limit se procesan todos los registros
+    etl.run_etl(limit=args.limit, fetch_size=args.fetch_size, normalize_only=args.normalize_only,
+                since=args.since, full_refresh=args.full_refresh, workers=args.workers)
@@ -0,0 +1,5 @@
+-- Índice sobre Orden.fecha para la extracción incremental del ETL
+-- (backfill con --since filtra por o.fecha >= 'YYYY-MM-DD'; la carga normal usa la llave primaria Orden.id)
+USE sales_mysql;
+
+CREATE INDEX IX_Orden_fecha ON Orden(fecha);
@@ -0,0 +1,18 @@
+-- Columna numérica normalizada para OrdenDetalle.precio_unit
+-- La llena la etapa normalize_prices del ETL (python ETL_MYSQL_TO_DW.py --normalize-only para el histórico)
+USE sales_mysql;
+
+ALTER TABLE OrdenDetalle ADD COLUMN precio_unit_num DECIMAL(18,2) NULL;
+CREATE INDEX IX_Detalle_precio_num ON OrdenDetalle(precio_unit_num);
+
+-- Si se corrige el precio en texto, se marca la fila como pendiente de normalizar
+DELIMITER //
+CREATE TRIGGER TR_OrdenDetalle_precio_pendiente
+BEFORE UPDATE ON OrdenDetalle
+FOR EACH ROW
+BEGIN
+	IF NEW.precio_unit <> OLD.precio_unit THEN
+		SET NEW.precio_unit_num = NULL;
+	END IF;
+END //
+DELIMITER ;
@@ -32,8 +32,23 @@ CREATE TABLE OrdenDetalle (
 	producto_id INT NOT NULL,
 	cantidad INT NOT NULL,
 	precio_unit VARCHAR(20) NOT NULL, -- string con comas/puntos
+	precio_unit_num DECIMAL(18,2) NULL, -- precio_unit limpio, lo llena la etapa normalize_prices del ETL
 	FOREIGN KEY (orden_id) REFERENCES Orden(id),
 	FOREIGN KEY (producto_id) REFERENCES Producto(id)
 );
 CREATE INDEX IX_Orden_cliente ON Orden(cliente_id);
-CREATE INDEX IX_Detalle_producto ON OrdenDetalle(producto_id);
\ No newline at end of file
+CREATE INDEX IX_Detalle_producto ON OrdenDetalle(producto_id);
+CREATE INDEX IX_Orden_fecha ON Orden(fecha);
+CREATE INDEX IX_Detalle_precio_num ON OrdenDetalle(precio_unit_num);
+
+-- Si se corrige el precio en texto, se marca la fila como pendiente de normalizar
+DELIMITER //
+CREATE TRIGGER TR_OrdenDetalle_precio_pendiente
+BEFORE UPDATE ON OrdenDetalle
+FOR EACH ROW
+BEGIN
+	IF NEW.precio_unit <> OLD.precio_unit THEN
+		SET NEW.precio_unit_num = NULL;
+	END IF;
+END //
+DELIMITER ;
\ No newline at end of file
@@ -1,5 +1,6 @@
 import os
 import json
+import time
 from neo4j import GraphDatabase
 import pyodbc
 from datetime import datetime, date
@@ -15,6 +16,13 @@ DB_NAME = os.getenv("NEO4J_DATABASE", "ventas")  # base de datos a extraer
 #configuracion log
 LOG_PATH = os.getenv("LOG_PATH", "etl_ventas.log")
 LOG_FECHA_DEFAULT = datetime(1970, 1, 1).isoformat() + "Z"
+#configuracion extraccion
+BATCH_SIZE = int(os.getenv("NEO4J_BATCH_SIZE", "1000"))  # fetch size de la sesión y órdenes por consulta de relaciones
+RELS_EN_NODOS = os.getenv("NEO4J_RELS_EN_NODOS", "0") == "1"  # extraer relaciones en la misma consulta de nodos
+# etiquetas con propiedad fecha (datetime nativo) e índice sobre ella; se extraen una por una
+ETIQUETAS = [e.strip() for e in os.getenv("NEO4J_ETIQUETAS", "Producto,Cliente,Orden").split(",") if e.strip()]
+#columna Fuente de FactVentas (los MERGE de SQL Server y MongoDB solo tocan sus propias filas)
+FUENTE = "NEO4J"
 
 def consultarlogetlventas():
     try:
@@ -42,7 +50,15 @@ def crearlogetlventas(fecha):
     with open(LOG_PATH, "a", encoding="utf-8") as f:
         f.write(str(fecha) + "\n")
 
-def extract_nodes(session, fecha=None, out_path="nodes.jsonl", batch_size=1000):
+# Datos de una relación de la orden y del nodo del otro extremo (producto, cliente, ...)
+REL_MAP = (
+    "{from: elementId(startNode(r)), to: elementId(endNode(r)), rel: elementId(r), type: type(r), "
+    "props: properties(r), otherId: elementId(x), otherLabels: labels(x), otherProps: properties(x)}"
+)
+
+
+def extract_nodes(session, fecha=None, out_path="nodes.jsonl", batch_size=1000,
+                  rels_path=None, neighbors_path="neighbors.jsonl", labels=None):
     if fecha is None:
         try:
             fecha = consultarlogetlventas()
@@ -50,59 +66,132 @@ def extract_nodes(session, fecha=None, out_path="nodes.jsonl", batch_size=1000):
             # Fallback to epoch-like default if the log can't be read
             fecha = LOG_FECHA_DEFAULT
 
-    # Cypher: only return nodes that have a fecha and where datetime(n.fecha) > datetime($fecha)
-    query = (
-        "MATCH (n) WHERE n.fecha IS NOT NULL AND datetime(n.fecha) > datetime($fecha) "
-        "RETURN elementId(n) AS elementId, labels(n) AS labels, properties(n) AS props"
-    )
-
-    with open(out_path, "w", encoding="utf-8") as f:
-        for record in session.run(query, fecha=fecha):
-            obj = {"elementId": record["elementId"], "labels": record["labels"], "props": record["props"]}
-            f.write(json.dumps(obj, default=str, ensure_ascii=False) + "\n")
+    if labels is None:
+        labels = ETIQUETAS
 
-def extract_rels(session, nodes_path="nodes.jsonl", out_path="relationships.jsonl"):
-    # Load node elementIds
+    seen = set()
+    neighbors = {}
+    total = 0
+    inicio = time.perf_counter()
+    fr = open(rels_path, "w", encoding="utf-8") if rels_path else None
     try:
-        nodes = read_jsonl(nodes_path)
-    except FileNotFoundError:
-        raise FileNotFoundError(f"Nodes file not found: {nodes_path}")
+        with open(out_path, "w", encoding="utf-8") as f:
+            for label in labels:
+                # Una consulta por etiqueta: el rango sobre la propiedad nativa n.fecha usa el índice
+                # (label, fecha); datetime($fecha) se evalúa una sola vez y no por cada nodo
+                query = f"MATCH (n:`{label}`) WHERE n.fecha > datetime($fecha) "
+                if fr and label == "Orden":
+                    # Modo combinado: en la misma consulta se traen las relaciones de cada Orden extraída
+                    query += (
+                        "OPTIONAL MATCH (n)-[r]-(x) "
+                        "WITH n, collect(" + REL_MAP + ") AS rels "
+                        "RETURN elementId(n) AS elementId, labels(n) AS labels, properties(n) AS props, rels"
+                    )
+                else:
+                    query += "RETURN elementId(n) AS elementId, labels(n) AS labels, properties(n) AS props, [] AS rels"
+
+                count = 0
+                inicio_label = time.perf_counter()
+                # Los registros llegan del servidor en bloques del fetch_size de la sesión y se escriben al vuelo
+                for record in session.run(query, fecha=fecha):
+                    obj = {"elementId": record["elementId"], "labels": record["labels"], "props": record["props"]}
+                    f.write(json.dumps(obj, default=str, ensure_ascii=False) + "\n")
+                    for rel in record["rels"]:
+                        # OPTIONAL MATCH sin coincidencias deja un mapa con valores nulos
+                        if rel["rel"] is None:
+                            continue
+                        _write_rel(fr, rel, seen, neighbors)
+                    count += 1
+                    if count % batch_size == 0:
+                        elapsed = time.perf_counter() - inicio_label
+                        print(f"  {label}: {count} nodos ({count / elapsed:.0f} nodos/s)")
+
+                elapsed = time.perf_counter() - inicio_label
+                print(f"  {label}: {count} nodos extraídos en {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f} nodos/s)")
+                total += count
+    finally:
+        if fr:
+            fr.close()
 
-    ids = [n["elementId"] for n in nodes if "elementId" in n]
+    if rels_path:
+        _write_neighbors(neighbors, neighbors_path)
+
+    elapsed = time.perf_counter() - inicio
+    print(f"Total: {total} nodos en {elapsed:.2f}s ({total / elapsed if elapsed else 0:.0f} nodos/s)")
+    return total
 
-    if not ids:
-        # No nodes extracted; create empty output and return
-        with open(out_path, "w", encoding="utf-8") as f:
-            return
 
-    # Query relationships where both endpoints are in the extracted node set
+def _write_rel(f, rel, seen, neighbors):
+    # Cada relación se escribe una sola vez aunque aparezca desde dos órdenes
+    if rel["rel"] in seen:
+        return
+    seen.add(rel["rel"])
+    obj = {
+        "from": rel["from"],
+        "to": rel["to"],
+        "rel": rel["rel"],
+        "type": rel["type"],
+        "props": rel["props"]
+    }
+    f.write(json.dumps(obj, default=str, ensure_ascii=False) + "\n")
+    if rel["otherId"] not in neighbors:
+        neighbors[rel["otherId"]] = {"elementId": rel["otherId"], "labels": rel["otherLabels"], "props": rel["otherProps"]}
+
+
+def _write_neighbors(neighbors, neighbors_path):
+    # Nodos del otro extremo (productos y clientes con fecha anterior al log, que no salen en nodes.jsonl)
+    # para que transform_and_load los cargue en las dimensiones y resuelva las relaciones
+    with open(neighbors_path, "w", encoding="utf-8") as f:
+        for obj in neighbors.values():
+            f.write(json.dumps(obj, default=str, ensure_ascii=False) + "\n")
+
+
+def extract_rels(session, nodes_path="nodes.jsonl", out_path="relationships.jsonl",
+                 neighbors_path="neighbors.jsonl", batch_size=1000):
+    if not os.path.exists(nodes_path):
+        raise FileNotFoundError(f"Nodes file not found: {nodes_path}")
+
+    # Anclar en las órdenes extraídas: cada lote busca por elementId y expande solo sus relaciones,
+    # así el costo crece con la cantidad de órdenes nuevas y no con el tamaño del grafo
     query = (
-        "MATCH (a)-[r]->(b)"
-        " WHERE elementId(a) IN $ids AND elementId(b) IN $ids"
-        " RETURN elementId(a) AS from, elementId(b) AS to, elementId(r) AS rel, type(r) AS type, properties(r) AS props"
+        "UNWIND $batch AS id "
+        "MATCH (o) WHERE elementId(o) = id "
+        "MATCH (o)-[r]-(x) "
+        "RETURN elementId(startNode(r)) AS from, elementId(endNode(r)) AS to, elementId(r) AS rel, "
+        "type(r) AS type, properties(r) AS props, "
+        "elementId(x) AS otherId, labels(x) AS otherLabels, properties(x) AS otherProps"
     )
 
+    seen = set()
+    neighbors = {}
+    batch = []
     with open(out_path, "w", encoding="utf-8") as f:
-        for record in session.run(query, ids=ids):
-            obj = {
-                "from": record["from"],
-                "to": record["to"],
-                "rel": record["rel"],
-                "type": record["type"],
-                "props": record["props"]
-            }
-            f.write(json.dumps(obj, default=str, ensure_ascii=False) + "\n")
+        for n in iter_jsonl(nodes_path):
+            if "Orden" not in n.get("labels", []) or "elementId" not in n:
+                continue
+            batch.append(n["elementId"])
+            if len(batch) >= batch_size:
+                for record in session.run(query, batch=batch):
+                    _write_rel(f, record, seen, neighbors)
+                batch = []
+        if batch:
+            for record in session.run(query, batch=batch):
+                _write_rel(f, record, seen, neighbors)
 
+    _write_neighbors(neighbors, neighbors_path)
 
-def read_jsonl(path):
-    items = []
+
+def iter_jsonl(path):
     with open(path, "r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
             if not line:
                 continue
-            items.append(json.loads(line))
-    return items
+            yield json.loads(line)
+
+
+def read_jsonl(path):
+    return list(iter_jsonl(path))
 
 
 def get_max_fecha_from_nodes(nodes_path="nodes.jsonl"):
@@ -236,14 +325,20 @@ CREATE TABLE IF NOT EXISTS Equivalencias (
     conn.commit()
 '''
 
-def transform_and_load(nodes_path="nodes.jsonl", rels_path="relationships.jsonl"):
+def transform_and_load(nodes_path="nodes.jsonl", rels_path="relationships.jsonl", neighbors_path="neighbors.jsonl"):
     nodes = read_jsonl(nodes_path)
     rels = read_jsonl(rels_path)
 
     nodes_map = {n["elementId"]: n for n in nodes}
-
-    productos = [n for n in nodes if "Producto" in n.get("labels", [])]
-    clientes = [n for n in nodes if "Cliente" in n.get("labels", [])]
+    # Productos y clientes conectados a las órdenes cuya fecha es anterior a la del log:
+    # no salen en nodes.jsonl, pero se cargan igual en las dimensiones (si ya existen se omiten)
+    # y sirven para resolver las relaciones de las órdenes
+    if neighbors_path and os.path.exists(neighbors_path):
+        for n in iter_jsonl(neighbors_path):
+            nodes_map.setdefault(n["elementId"], n)
+
+    productos = [n for n in nodes_map.values() if "Producto" in n.get("labels", [])]
+    clientes = [n for n in nodes_map.values() if "Cliente" in n.get("labels", [])]
     ordenes = [n for n in nodes if "Orden" in n.get("labels", [])]
 
     # Conectar a SQL Server y crear las tablas DW si es necesario
@@ -666,6 +761,9 @@ def transform_and_load(nodes_path="nodes.jsonl", rels_path="relationships.jsonl"
                     acc["precio_count"] += 1
 
         # Insertar agregados en FactVentas
+        # DW creado antes de la columna Fuente (ver dw/MigracionFuenteFactVentas.sql)
+        cur.execute("IF COL_LENGTH('dbo.FactVentas', 'Fuente') IS NULL ALTER TABLE FactVentas ADD Fuente VARCHAR(20) NULL")
+        conn.commit()
         for key, vals in agrupados.items():
             fecha_iso, sku_val, cliente_email_val, canal_val = key
             fecha_date = vals.get("fecha")
@@ -788,8 +886,8 @@ def transform_and_load(nodes_path="nodes.jsonl", rels_path="relationships.jsonl"
             # Insertar en FactVentas
             try:
                 cur.execute(
-                    "INSERT INTO FactVentas (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (id_tiempo, id_producto, id_cliente, id_canal, total_ventas, cantidad_total, precio_prom)
+                    "INSERT INTO FactVentas (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio, Fuente) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (id_tiempo, id_producto, id_cliente, id_canal, total_ventas, cantidad_total, precio_prom, FUENTE)
                 )
                 conn.commit()
                 print(f"Insertada FactVentas Fecha={fecha_date} SKU={sku_real} IdProducto={id_producto} IdCliente={id_cliente} IdCanal={id_canal} Total={total_ventas} Cant={cantidad_total} Precio={precio_prom}")
@@ -804,18 +902,25 @@ def transform_and_load(nodes_path="nodes.jsonl", rels_path="relationships.jsonl"
 def main():
     driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASS))
     try:
-        with driver.session(database=DB_NAME) as session:
+        with driver.session(database=DB_NAME, fetch_size=BATCH_SIZE) as session:
             print(f"Extrayendo nodos desde DB '{DB_NAME}'...")
             # Use the last logged fecha as the lower bound for extraction
             ultima_fecha = consultarlogetlventas()
 
             print(f"Extrayendo nodos con fecha posterior a: {ultima_fecha}")
-            extract_nodes(session, fecha=ultima_fecha, out_path="nodes.jsonl")
-            print("Nodos exportados a nodes.jsonl")
+            if RELS_EN_NODOS:
+                # Una sola consulta trae los nodos y las relaciones de cada orden
+                extract_nodes(session, fecha=ultima_fecha, out_path="nodes.jsonl", batch_size=BATCH_SIZE,
+                              rels_path="relationships.jsonl", neighbors_path="neighbors.jsonl")
+                print("Nodos y relaciones exportados a nodes.jsonl y relationships.jsonl")
+            else:
+                extract_nodes(session, fecha=ultima_fecha, out_path="nodes.jsonl", batch_size=BATCH_SIZE)
+                print("Nodos exportados a nodes.jsonl")
 
-            print("Extrayendo relaciones entre nodos extraídos...")
-            extract_rels(session, nodes_path="nodes.jsonl", out_path="relationships.jsonl")
-            print("Relaciones exportadas a relationships.jsonl")
+                print("Extrayendo relaciones de las órdenes extraídas...")
+                extract_rels(session, nodes_path="nodes.jsonl", out_path="relationships.jsonl",
+                             neighbors_path="neighbors.jsonl", batch_size=BATCH_SIZE)
+                print("Relaciones exportadas a relationships.jsonl")
             # Compute the most recent fecha among extracted nodes and write it to the log
             max_fecha = get_max_fecha_from_nodes(nodes_path="nodes.jsonl")
             if max_fecha:
@@ -828,7 +933,7 @@ def main():
         driver.close()
 
     # Transformar y cargar los datos extraídos
-    transform_and_load(nodes_path="nodes.jsonl", rels_path="relationships.jsonl")
+    transform_and_load(nodes_path="nodes.jsonl", rels_path="relationships.jsonl", neighbors_path="neighbors.jsonl")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
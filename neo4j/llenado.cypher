@@ -292,8 +292,10 @@ RETURN count(c) AS clientes_creados;
 //--------------- Crear 5000 nodos Orden con relaciones -----------------
 //------------------------------------------------------------------------
 
-// Crear índice para fechas de orden
+// Crear índices para fechas de orden, cliente y producto (el ETL los usa para extraer por rango)
 CREATE INDEX orden_fecha IF NOT EXISTS FOR (o:Orden) ON (o.fecha);
+CREATE INDEX cliente_fecha IF NOT EXISTS FOR (c:Cliente) ON (c.fecha);
+CREATE INDEX producto_fecha IF NOT EXISTS FOR (p:Producto) ON (p.fecha);
 
 // Crear 5000 órdenes con productos y clientes
 MATCH (c:Cliente)
@@ -1,10 +1,24 @@
 import pyodbc
 import logging
-from datetime import datetime
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import platform
 import os
+import sys
 from dotenv import load_dotenv
 
+# Utilidades compartidas del DW (dw/datoscomunes)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dw', 'datoscomunes'))
+from calendario import asegurar_dim_tiempo
+from metricas import get_peak_rss_mb
+
 # Cargar variables de entorno desde el archivo env.txt
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), 'env.txt'))
 
@@ -14,6 +28,220 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+
+class DimensionCache:
+    """
+    Caché LRU acotada de llaves de una dimensión (llave natural -> llave subrogada)
+    con contadores de aciertos y fallos.
+    """
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        """Retorna la llave subrogada o None, actualizando los contadores"""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def put(self, key, value):
+        """Agrega o refresca una entrada, descartando la menos usada si se excede el límite"""
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+    
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class RunMetrics:
+    """
+    Métricas por etapa de una ejecución del ETL: tiempo de pared, filas de entrada y
+    salida, round trips a la base de datos y commits. Las consultas se atribuyen a la
+    etapa activa del hilo que las ejecuta.
+    """
+    def __init__(self, etl_name):
+        self.etl_name = etl_name
+        self.stages = OrderedDict()
+        self.caches = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+    
+    def _get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {
+                'segundos': 0.0,
+                'filas_entrada': 0,
+                'filas_salida': 0,
+                'round_trips': 0,
+                'commits': 0
+            }
+        return self.stages[name]
+    
+    def current_stage(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else 'otros'
+    
+    @contextmanager
+    def stage(self, name):
+        """Acumula el tiempo de pared del bloque en la etapa indicada"""
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            stack.pop()
+            with self.lock:
+                self._get_stage(name)['segundos'] += elapsed
+    
+    def timed_iter(self, name, iterable):
+        """Itera midiendo en la etapa indicada el tiempo de obtener cada elemento"""
+        iterator = iter(iterable)
+        try:
+            while True:
+                with self.stage(name):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                self.add_rows(name, filas_salida=1)
+                yield item
+        finally:
+            # Propagar el cierre al generador de origen (libera cursores y workers)
+            if hasattr(iterator, 'close'):
+                iterator.close()
+    
+    def count(self, field, amount=1, stage=None):
+        with self.lock:
+            self._get_stage(stage or self.current_stage())[field] += amount
+    
+    def add_rows(self, name, filas_entrada=0, filas_salida=0):
+        with self.lock:
+            stage = self._get_stage(name)
+            stage['filas_entrada'] += filas_entrada
+            stage['filas_salida'] += filas_salida
+    
+    def to_dict(self):
+        return {
+            'etl': self.etl_name,
+            'inicio': datetime.fromtimestamp(self.started_at).isoformat(),
+            'segundos_totales': time.perf_counter() - self.started,
+            'pico_rss_mb': get_peak_rss_mb(),
+            'etapas': self.stages,
+            'caches': {
+                cache.name: {
+                    'aciertos': cache.hits,
+                    'fallos': cache.misses,
+                    'tasa_aciertos': cache.hit_rate()
+                }
+                for cache in self.caches
+            }
+        }
+    
+    def to_prometheus(self):
+        """Exporta las métricas en formato de texto de Prometheus (textfile collector)"""
+        report = self.to_dict()
+        etl = self.etl_name
+        lines = []
+        
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                label_str = ",".join(f'{k}="{v}"' for k, v in [('etl', etl)] + labels)
+                lines.append(f"{name}{{{label_str}}} {value}")
+        
+        etapas = report['etapas'].items()
+        metric('etl_stage_seconds', 'Tiempo de pared por etapa',
+               [([('stage', n)], e['segundos']) for n, e in etapas])
+        metric('etl_stage_rows_in', 'Filas de entrada por etapa',
+               [([('stage', n)], e['filas_entrada']) for n, e in etapas])
+        metric('etl_stage_rows_out', 'Filas de salida por etapa',
+               [([('stage', n)], e['filas_salida']) for n, e in etapas])
+        metric('etl_stage_round_trips', 'Round trips a la base de datos por etapa',
+               [([('stage', n)], e['round_trips']) for n, e in etapas])
+        metric('etl_stage_commits', 'Commits por etapa',
+               [([('stage', n)], e['commits']) for n, e in etapas])
+        metric('etl_cache_hit_ratio', 'Tasa de aciertos de las cachés de dimensiones',
+               [([('cache', n)], c['tasa_aciertos']) for n, c in report['caches'].items()])
+        metric('etl_run_seconds', 'Duración total de la ejecución', [([], report['segundos_totales'])])
+        metric('etl_run_timestamp_seconds', 'Inicio de la ejecución (epoch)', [([], self.started_at)])
+        if report['pico_rss_mb'] is not None:
+            metric('etl_peak_rss_megabytes', 'Pico de memoria residente', [([], report['pico_rss_mb'])])
+        
+        return "\n".join(lines) + "\n"
+    
+    def write_reports(self, json_path, prometheus_path):
+        """Escribe el reporte JSON y el archivo Prometheus (archivo temporal + reemplazo)"""
+        for path, content in (
+            (json_path, json.dumps(self.to_dict(), indent=2, default=str)),
+            (prometheus_path, self.to_prometheus())
+        ):
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        logging.info(f"Reporte de ejecución escrito en {json_path} y {prometheus_path}")
+
+
+class InstrumentedCursor:
+    """Cursor pyodbc que cuenta los round trips en las métricas de la ejecución"""
+    def __init__(self, cursor, metrics, stage=None):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_metrics', metrics)
+        object.__setattr__(self, '_stage', stage)
+    
+    def execute(self, *args, **kwargs):
+        self._metrics.count('round_trips', stage=self._stage)
+        return self._cursor.execute(*args, **kwargs)
+    
+    def executemany(self, *args, **kwargs):
+        self._metrics.count('round_trips', stage=self._stage)
+        return self._cursor.executemany(*args, **kwargs)
+    
+    def fetchmany(self, *args, **kwargs):
+        self._metrics.count('round_trips', stage=self._stage)
+        return self._cursor.fetchmany(*args, **kwargs)
+    
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+    
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+
+class InstrumentedConnection:
+    """Conexión pyodbc que cuenta commits y entrega cursores instrumentados"""
+    def __init__(self, connection, metrics, stage=None):
+        self._connection = connection
+        self._metrics = metrics
+        self._stage = stage
+    
+    def cursor(self):
+        return InstrumentedCursor(self._connection.cursor(), self._metrics, self._stage)
+    
+    def commit(self):
+        self._metrics.count('commits', stage=self._stage)
+        self._metrics.count('round_trips', stage=self._stage)
+        return self._connection.commit()
+    
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
 class SQLServerToDW_ETL:
     def __init__(self):
         # Configuración de SQL Server ORIGEN (ventas_ms)
@@ -53,28 +281,62 @@ class SQLServerToDW_ETL:
         # Tipo de cambio por defecto CRC→USD si no se encuentra en la tabla
         self.default_crc_to_usd_rate = 0.0019  # ~520 CRC por USD
         
+        # Carga masiva de FactVentas (tabla staging + fast_executemany)
+        self.bulk_load = os.getenv("ETL_BULK_LOAD", "1") != "0"
+        self.batch_size = int(os.getenv("ETL_BATCH_SIZE", "5000"))
+        
+        # Tamaño de bloque para fetchmany en la extracción (memoria acotada)
+        self.fetch_size = int(os.getenv("ETL_FETCH_SIZE", "5000"))
+        
+        # Extracción paralela por particiones de fechas (1 worker = extracción secuencial)
+        self.workers = int(os.getenv("ETL_WORKERS", "1"))
+        self.partition_days = int(os.getenv("ETL_PARTITION_DAYS", "30"))
+        
+        # Cachés de llaves de dimensiones (se pre-cargan desde el DW al iniciar)
+        cache_size = int(os.getenv("ETL_CACHE_SIZE", "100000"))
+        self.cliente_cache = DimensionCache('DimCliente', cache_size)
+        self.producto_cache = DimensionCache('DimProducto', cache_size)
+        self.tiempo_cache = DimensionCache('DimTiempo', cache_size)
+        self.canal_cache = DimensionCache('DimCanal', cache_size)
+        
+        # Instrumentación por etapa y reportes de la ejecución (JSON + Prometheus)
+        self.metrics = RunMetrics('sqlserver')
+        self.metrics.caches = [self.cliente_cache, self.producto_cache, self.tiempo_cache, self.canal_cache]
+        report_dir = os.getenv("ETL_REPORT_DIR", os.path.dirname(os.path.abspath(__file__)))
+        self.report_json_path = os.path.join(report_dir, 'etl_run_report.json')
+        self.report_prometheus_path = os.path.join(report_dir, 'etl_metrics.prom')
+        
+        # Marca de agua (última Orden.Fecha / OrdenId cargada) para la extracción incremental
+        self.watermark_path = os.path.join(os.path.dirname(__file__), 'etl_watermark.json')
+        
+        # Última versión de Change Tracking sincronizada (modo --change-tracking)
+        self.change_tracking_path = os.path.join(os.path.dirname(__file__), 'etl_change_tracking.json')
+        
+    def source_connection_string(self):
+        """Arma el connection string de SQL Server origen (ventas_ms)"""
+        if self.source_username and self.source_password:
+            return (
+                f"DRIVER={{{self.driver}}};"
+                f"SERVER={self.source_server};"
+                f"DATABASE={self.source_database};"
+                f"UID={self.source_username};"
+                f"PWD={self.source_password};"
+                f"TrustServerCertificate=yes;"
+            )
+        # Usar autenticación de Windows
+        return (
+            f"DRIVER={{{self.driver}}};"
+            f"SERVER={self.source_server};"
+            f"DATABASE={self.source_database};"
+            f"Trusted_Connection=yes;"
+        )
+    
     def connect_source(self):
         """Conecta a la base de datos SQL Server origen (ventas_ms)"""
         try:
-            if self.source_username and self.source_password:
-                connection_string = (
-                    f"DRIVER={{{self.driver}}};"
-                    f"SERVER={self.source_server};"
-                    f"DATABASE={self.source_database};"
-                    f"UID={self.source_username};"
-                    f"PWD={self.source_password};"
-                    f"TrustServerCertificate=yes;"
-                )
-            else:
-                # Usar autenticación de Windows
-                connection_string = (
-                    f"DRIVER={{{self.driver}}};"
-                    f"SERVER={self.source_server};"
-                    f"DATABASE={self.source_database};"
-                    f"Trusted_Connection=yes;"
-                )
-            
-            self.source_connection = pyodbc.connect(connection_string)
+            self.source_connection = InstrumentedConnection(
+                pyodbc.connect(self.source_connection_string()), self.metrics
+            )
             logging.info(f"Conexión exitosa a SQL Server origen: {self.source_database}")
         except Exception as e:
             logging.error(f"Error conectando a SQL Server origen: {e}")
@@ -101,7 +363,7 @@ class SQLServerToDW_ETL:
                     f"Trusted_Connection=yes;"
                 )
             
-            self.dw_connection = pyodbc.connect(connection_string)
+            self.dw_connection = InstrumentedConnection(pyodbc.connect(connection_string), self.metrics)
             logging.info(f"Conexión exitosa a Data Warehouse: {self.dw_database}")
         except Exception as e:
             logging.error(f"Error conectando a Data Warehouse: {e}")
@@ -142,6 +404,11 @@ class SQLServerToDW_ETL:
         Obtiene o crea un cliente en DimCliente.
         Usa el email como clave natural para evitar duplicados.
         """
+        cache_key = self.normalize_key(cliente_data['email'])
+        cliente_id = self.cliente_cache.get(cache_key)
+        if cliente_id:
+            return cliente_id
+        
         try:
             cursor = self.dw_connection.cursor()
             
@@ -151,6 +418,7 @@ class SQLServerToDW_ETL:
             result = cursor.fetchone()
             
             if result:
+                self.cliente_cache.put(cache_key, int(result[0]))
                 return result[0]
             
             # Si no existe, crear uno nuevo
@@ -178,6 +446,7 @@ class SQLServerToDW_ETL:
             self.dw_connection.commit()
             
             logging.info(f"Cliente creado: {cliente_data['email']} - ID: {cliente_id}")
+            self.cliente_cache.put(cache_key, int(cliente_id))
             return int(cliente_id)
             
         except Exception as e:
@@ -189,6 +458,11 @@ class SQLServerToDW_ETL:
         Procesa equivalencias y obtiene/crea un producto en DimProducto.
         Usa la tabla Equivalencias para mapear SKU de diferentes fuentes.
         """
+        cache_key = self.normalize_key(producto_data['sku'])
+        producto_id = self.producto_cache.get(cache_key)
+        if producto_id:
+            return producto_id
+        
         try:
             cursor = self.dw_connection.cursor()
             
@@ -213,6 +487,7 @@ class SQLServerToDW_ETL:
                 if result:
                     producto_id = result[0]
                     logging.info(f"Encontrado producto existente - ID: {producto_id}")
+                    self.producto_cache.put(cache_key, int(producto_id))
                     return int(producto_id)
             
             # Si no existe equivalencia, crear una nueva
@@ -246,6 +521,7 @@ class SQLServerToDW_ETL:
                 logging.info(f"Producto creado: {nombre} - ID: {producto_id}, SKU: {sku_oficial}")
             
             self.dw_connection.commit()
+            self.producto_cache.put(cache_key, int(producto_id))
             return int(producto_id)
             
         except Exception as e:
@@ -256,17 +532,22 @@ class SQLServerToDW_ETL:
         """
         Obtiene o crea un registro en DimTiempo para una fecha específica.
         """
+        # Convertir a date si es datetime
+        fecha_buscar = fecha.date() if hasattr(fecha, 'date') else fecha
+        
+        tiempo_id = self.tiempo_cache.get(fecha_buscar)
+        if tiempo_id:
+            return tiempo_id
+        
         try:
             cursor = self.dw_connection.cursor()
             
-            # Convertir a date si es datetime
-            fecha_buscar = fecha.date() if hasattr(fecha, 'date') else fecha
-            
             query = "SELECT IdTiempo FROM DimTiempo WHERE Fecha = ?"
             cursor.execute(query, fecha_buscar)
             result = cursor.fetchone()
             
             if result:
+                self.tiempo_cache.put(fecha_buscar, int(result[0]))
                 return result[0]
             
             # Crear nuevo registro de tiempo
@@ -288,7 +569,7 @@ class SQLServerToDW_ETL:
             dia = fecha_obj.day
             semana = fecha_obj.isocalendar()[1]
             dia_semana = fecha_obj.strftime('%A')
-            tipo_cambio = 1.0  # USD por defecto
+            tipo_cambio = None  # lo completa la carga de tipos de cambio (1.0 se tomaría como tasa real)
             
             cursor.execute(insert_query, (
                 anio, mes, dia, fecha_buscar, semana, dia_semana, tipo_cambio
@@ -299,16 +580,36 @@ class SQLServerToDW_ETL:
             self.dw_connection.commit()
             
             logging.info(f"DimTiempo creado para fecha: {fecha_buscar} - ID: {tiempo_id}")
+            self.tiempo_cache.put(fecha_buscar, int(tiempo_id))
             return int(tiempo_id)
             
         except Exception as e:
             logging.error(f"Error obteniendo/creando DimTiempo: {e}")
             return None
     
+    def prepare_dim_tiempo(self, fecha_min, fecha_max):
+        """
+        Genera en bloque las fechas faltantes de DimTiempo para la ventana de extracción
+        antes de procesar los hechos; después get_or_create_tiempo se resuelve en memoria.
+        """
+        try:
+            mapa_tiempo = asegurar_dim_tiempo(self.dw_connection, fecha_min, fecha_max)
+            for fecha, tiempo_id in mapa_tiempo.items():
+                self.tiempo_cache.put(fecha, tiempo_id)
+            logging.info(f"DimTiempo listo para {len(mapa_tiempo)} fechas ({fecha_min} a {fecha_max})")
+        except Exception as e:
+            # get_or_create_tiempo sigue creando fechas una a una si esto falla
+            logging.error(f"Error generando calendario de DimTiempo: {e}")
+    
     def get_or_create_canal(self, canal_nombre):
         """
         Obtiene o crea un canal en DimCanal.
         """
+        cache_key = self.normalize_key(canal_nombre)
+        canal_id = self.canal_cache.get(cache_key)
+        if canal_id:
+            return canal_id
+        
         try:
             cursor = self.dw_connection.cursor()
             
@@ -318,6 +619,7 @@ class SQLServerToDW_ETL:
             result = cursor.fetchone()
             
             if result:
+                self.canal_cache.put(cache_key, int(result[0]))
                 return result[0]
             
             # Crear nuevo canal
@@ -328,149 +630,649 @@ class SQLServerToDW_ETL:
             self.dw_connection.commit()
             
             logging.info(f"Canal creado: {canal_nombre} - ID: {canal_id}")
+            self.canal_cache.put(cache_key, int(canal_id))
             return int(canal_id)
             
         except Exception as e:
             logging.error(f"Error obteniendo/creando DimCanal: {e}")
             return None
     
-    def process_orders(self, limit=None):
+    def normalize_key(self, value):
+        """Normaliza una llave de texto como la compara SQL Server (sin mayúsculas ni espacios finales)"""
+        return (value or '').rstrip().lower()
+    
+    def fact_key(self, email, sku, fecha):
         """
-        Procesa las órdenes desde SQL Server origen y las carga en FactVentas.
-        Agrupa por cliente, producto y fecha para evitar duplicados.
+        Llave natural (Email, SKU, Fecha) de una venta en FactVentas.
+        """
+        fecha = fecha.date() if isinstance(fecha, datetime) else fecha
+        return (self.normalize_key(email), self.normalize_key(sku), fecha)
+    
+    def warm_dimension_caches(self):
+        """
+        Pre-carga las cachés de dimensiones con las llaves que ya existen en el DW,
+        para que las búsquedas repetidas no consulten la base de datos.
         """
         try:
-            source_cursor = self.source_connection.cursor()
-            
-            # Query para obtener ventas agregadas por cliente/producto/fecha/canal
-            query = """
-                SELECT 
-                    c.ClienteId,
-                    c.Nombre,
-                    c.Email,
-                    c.Genero,
-                    c.Pais,
-                    c.FechaRegistro,
-                    p.ProductoId,
-                    p.SKU,
-                    p.Nombre as ProductoNombre,
-                    p.Categoria,
-                    CAST(o.Fecha AS DATE) as Fecha,
-                    o.Canal,
-                    SUM(od.Cantidad) as CantidadTotal,
-                    AVG(od.PrecioUnit) as PrecioUnitPromedio,
-                    SUM(od.Cantidad * od.PrecioUnit * (1 - ISNULL(od.DescuentoPct, 0) / 100)) as TotalVentas
-                FROM sales_ms.OrdenDetalle od
-                INNER JOIN sales_ms.Orden o ON od.OrdenId = o.OrdenId
-                INNER JOIN sales_ms.Producto p ON od.ProductoId = p.ProductoId
-                INNER JOIN sales_ms.Cliente c ON o.ClienteId = c.ClienteId
-                GROUP BY 
-                    c.ClienteId, c.Nombre, c.Email, c.Genero, c.Pais, c.FechaRegistro,
-                    p.ProductoId, p.SKU, p.Nombre, p.Categoria,
-                    CAST(o.Fecha AS DATE), o.Canal
-            """
+            cursor = self.dw_connection.cursor()
             
-            if limit:
-                query += f" ORDER BY o.Fecha DESC OFFSET 0 ROWS FETCH NEXT {limit} ROWS ONLY"
+            cursor.execute("SELECT Email, IdCliente FROM DimCliente WHERE Email IS NOT NULL")
+            for email, cliente_id in cursor.fetchall():
+                self.cliente_cache.put(self.normalize_key(email), int(cliente_id))
             
-            source_cursor.execute(query)
-            ventas = source_cursor.fetchall()
+            # Solo SKUs con equivalencia y producto: es lo que resuelve process_equivalencias_and_get_producto
+            cursor.execute("""
+                SELECT e.SKU, p.IdProducto
+                FROM Equivalencias e
+                INNER JOIN DimProducto p ON p.SKU = e.SKU
+            """)
+            for sku, producto_id in cursor.fetchall():
+                self.producto_cache.put(self.normalize_key(sku), int(producto_id))
             
-            logging.info(f"Procesando {len(ventas)} registros agregados de ventas")
+            cursor.execute("SELECT Fecha, IdTiempo FROM DimTiempo")
+            for fecha, tiempo_id in cursor.fetchall():
+                self.tiempo_cache.put(fecha, int(tiempo_id))
             
-            processed_count = 0
-            error_count = 0
-            skipped_count = 0
+            cursor.execute("SELECT Nombre, IdCanal FROM DimCanal")
+            for nombre, canal_id in cursor.fetchall():
+                self.canal_cache.put(self.normalize_key(nombre), int(canal_id))
             
-            for venta in ventas:
+            logging.info(
+                f"Cachés de dimensiones pre-cargadas: "
+                f"{len(self.cliente_cache.entries)} clientes, "
+                f"{len(self.producto_cache.entries)} productos, "
+                f"{len(self.tiempo_cache.entries)} fechas, "
+                f"{len(self.canal_cache.entries)} canales"
+            )
+        except Exception as e:
+            logging.error(f"Error pre-cargando cachés de dimensiones: {e}")
+    
+    def read_watermark(self):
+        """
+        Lee la marca de agua persistida (última Orden.Fecha y OrdenId cargadas).
+        Retorna (fecha, orden_id) o (None, None) si no hay ejecuciones previas.
+        """
+        try:
+            if not os.path.exists(self.watermark_path):
+                logging.info("No se encontró marca de agua previa, se hará una carga completa")
+                return None, None
+            
+            with open(self.watermark_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            
+            fecha = datetime.fromisoformat(data['fecha'])
+            orden_id = int(data['orden_id'])
+            logging.info(f"Marca de agua encontrada: Fecha={fecha}, OrdenId={orden_id}")
+            return fecha, orden_id
+            
+        except Exception as e:
+            logging.error(f"Error leyendo marca de agua: {e}")
+            return None, None
+    
+    def save_watermark(self, fecha, orden_id):
+        """
+        Persiste la marca de agua de forma atómica (archivo temporal + reemplazo).
+        """
+        try:
+            tmp_path = self.watermark_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'fecha': fecha.isoformat(), 'orden_id': int(orden_id)}, f)
+            os.replace(tmp_path, self.watermark_path)
+            logging.info(f"Marca de agua actualizada: Fecha={fecha}, OrdenId={orden_id}")
+        except Exception as e:
+            logging.error(f"Error guardando marca de agua: {e}")
+    
+    def get_source_high_mark(self):
+        """
+        Retorna (Fecha, OrdenId) de la orden más reciente en ventas_ms, usada como
+        límite superior de la extracción. Retorna (None, None) si no hay órdenes.
+        """
+        cursor = self.source_connection.cursor()
+        cursor.execute("""
+            SELECT TOP 1 Fecha, OrdenId
+            FROM sales_ms.Orden
+            ORDER BY Fecha DESC, OrdenId DESC
+        """)
+        result = cursor.fetchone()
+        if not result:
+            return None, None
+        return result[0], result[1]
+    
+    def build_extraction_filter(self, high_mark, since=None, full_refresh=False):
+        """
+        Construye el filtro WHERE sobre sales_ms.Orden (alias o) para la extracción.
+        - full_refresh: sin límite inferior.
+        - since: órdenes desde esa fecha (backfill), ignora la marca de agua.
+        - por defecto: órdenes posteriores a la marca de agua persistida.
+        Los rangos sobre o.Fecha permiten usar el índice IX_Orden_Fecha.
+        Retorna (condiciones, parámetros).
+        """
+        conditions = []
+        params = []
+        
+        if full_refresh:
+            logging.info("Modo full refresh: se extraen todas las órdenes")
+        elif since is not None:
+            logging.info(f"Backfill desde {since}")
+            conditions.append("o.Fecha >= ?")
+            params.append(since)
+        else:
+            last_fecha, last_orden_id = self.read_watermark()
+            if last_fecha is not None:
+                conditions.append("o.Fecha >= ? AND (o.Fecha > ? OR o.OrdenId > ?)")
+                params.extend([last_fecha, last_fecha, last_orden_id])
+        
+        # Límite superior fijo para no mezclar órdenes que lleguen durante la ejecución
+        high_fecha, high_orden_id = high_mark
+        conditions.append("o.Fecha <= ? AND (o.Fecha < ? OR o.OrdenId <= ?)")
+        params.extend([high_fecha, high_fecha, high_orden_id])
+        
+        return conditions, params
+    
+    def get_source_date_window(self, conditions=None, params=None):
+        """
+        Retorna (fecha_min, fecha_max) de las órdenes en ventas_ms que cumplen el filtro.
+        Retorna (None, None) si no hay órdenes.
+        """
+        cursor = self.source_connection.cursor()
+        query = """
+            SELECT MIN(CAST(o.Fecha AS DATE)), MAX(CAST(o.Fecha AS DATE))
+            FROM sales_ms.Orden o
+        """
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        cursor.execute(query, params or [])
+        result = cursor.fetchone()
+        if not result:
+            return None, None
+        return result[0], result[1]
+    
+    def load_existing_fact_keys(self, fecha_min, fecha_max):
+        """
+        Carga en memoria las llaves naturales (Email, SKU, Fecha) que ya existen en
+        FactVentas dentro de la ventana de fechas indicada.
+        Reemplaza la verificación fila por fila contra FactVentas por un lookup en un set.
+        """
+        keys = set()
+        if fecha_min is None or fecha_max is None:
+            return keys
+        
+        cursor = self.dw_connection.cursor()
+        cursor.execute("""
+            SELECT DISTINCT c.Email, p.SKU, t.Fecha
+            FROM FactVentas fv
+            INNER JOIN DimCliente c ON fv.IdCliente = c.IdCliente
+            INNER JOIN DimProducto p ON fv.IdProducto = p.IdProducto
+            INNER JOIN DimTiempo t ON fv.IdTiempo = t.IdTiempo
+            WHERE t.Fecha BETWEEN ? AND ?
+        """, (fecha_min, fecha_max))
+        
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            for email, sku, fecha in rows:
+                keys.add(self.fact_key(email, sku, fecha))
+        
+        logging.info(f"Llaves existentes en FactVentas ({fecha_min} a {fecha_max}): {len(keys)}")
+        return keys
+    
+    def resolve_fact_row(self, venta):
+        """
+        Resuelve las llaves subrogadas de una venta transformada (creando los miembros
+        de dimensión que falten) y arma la fila para FactVentas:
+        (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio).
+        Retorna None si alguna dimensión no se pudo resolver.
+        """
+        # Procesar cliente
+        cliente_id = self.get_or_create_cliente(venta['cliente'])
+        if not cliente_id:
+            return None
+        
+        # Procesar producto con equivalencias
+        producto_id = self.process_equivalencias_and_get_producto(venta['producto'])
+        if not producto_id:
+            return None
+        
+        # Procesar tiempo
+        tiempo_id = self.get_or_create_tiempo(venta['fecha'])
+        if not tiempo_id:
+            return None
+        
+        # Procesar canal
+        canal_id = self.get_or_create_canal(venta['canal'])
+        if not canal_id:
+            return None
+        
+        # Montos ya están en USD
+        return (
+            tiempo_id,
+            producto_id,
+            cliente_id,
+            canal_id,
+            round(venta['total_ventas'], 2),
+            venta['cantidad_total'],
+            round(venta['precio_unit_promedio'], 2)
+        )
+    
+    def stage_fact_rows(self, fact_rows):
+        """
+        Envía filas de FactVentas a la tabla temporal #StageFactVentas con
+        fast_executemany. Retorna el cursor usado, para continuar con la carga set-based.
+        """
+        cursor = self.dw_connection.cursor()
+        cursor.fast_executemany = True
+        
+        # La tabla temporal vive mientras la conexión esté abierta
+        cursor.execute("""
+            IF OBJECT_ID('tempdb..#StageFactVentas') IS NULL
+                CREATE TABLE #StageFactVentas (
+                    IdTiempo INT NOT NULL,
+                    IdProducto INT NOT NULL,
+                    IdCliente INT NOT NULL,
+                    IdCanal INT NOT NULL,
+                    TotalVentas DECIMAL(18,2),
+                    Cantidad INT,
+                    Precio DECIMAL(18,2)
+                )
+        """)
+        cursor.execute("TRUNCATE TABLE #StageFactVentas")
+        
+        cursor.executemany("""
+            INSERT INTO #StageFactVentas (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, fact_rows)
+        
+        return cursor
+    
+    def bulk_insert_facts(self, fact_rows):
+        """
+        Carga un lote de filas en FactVentas de forma set-based.
+        Las filas (con llaves subrogadas ya resueltas) se envían a la tabla temporal
+        #StageFactVentas con fast_executemany y luego se insertan con un único
+        INSERT ... SELECT que ignora combinaciones ya existentes.
+        Las llaves subrogadas no se resuelven en el INSERT sino antes, en resolve_fact_row:
+        las dimensiones se pre-cargan en caché (warm_dimension_caches, prepare_dim_tiempo),
+        así que solo los miembros nuevos consultan el DW, y se siguen creando con las
+        reglas de get_or_create_* (Equivalencias, mapeo de género, etc.).
+        Retorna la cantidad de filas insertadas.
+        """
+        if not fact_rows:
+            return 0
+        
+        with self.metrics.stage('carga_hechos'):
+            inserted = self._bulk_insert_staged(fact_rows)
+        self.metrics.add_rows('carga_hechos', filas_entrada=len(fact_rows), filas_salida=inserted)
+        return inserted
+    
+    def _bulk_insert_staged(self, fact_rows):
+        cursor = self.stage_fact_rows(fact_rows)
+        
+        cursor.execute("""
+            INSERT INTO FactVentas (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio, Fuente)
+            SELECT s.IdTiempo, s.IdProducto, s.IdCliente, s.IdCanal, s.TotalVentas, s.Cantidad, s.Precio, ?
+            FROM #StageFactVentas s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM FactVentas fv
+                WHERE fv.IdTiempo = s.IdTiempo
+                  AND fv.IdProducto = s.IdProducto
+                  AND fv.IdCliente = s.IdCliente
+                  AND fv.IdCanal = s.IdCanal
+            )
+        """, self.source_system)
+        inserted = cursor.rowcount
+        self.dw_connection.commit()
+        
+        return inserted
+    
+    def build_orders_query(self, conditions, joins=""):
+        """
+        Query para obtener ventas agregadas por cliente/producto/fecha/canal
+        filtrando las órdenes con las condiciones indicadas.
+        joins permite agregar un INNER JOIN extra (por ejemplo, contra una tabla temporal).
+        """
+        return """
+            SELECT 
+                c.ClienteId,
+                c.Nombre,
+                c.Email,
+                c.Genero,
+                c.Pais,
+                c.FechaRegistro,
+                p.ProductoId,
+                p.SKU,
+                p.Nombre as ProductoNombre,
+                p.Categoria,
+                CAST(o.Fecha AS DATE) as Fecha,
+                o.Canal,
+                SUM(od.Cantidad) as CantidadTotal,
+                AVG(od.PrecioUnit) as PrecioUnitPromedio,
+                SUM(od.Cantidad * od.PrecioUnit * (1 - ISNULL(od.DescuentoPct, 0) / 100)) as TotalVentas
+            FROM sales_ms.OrdenDetalle od
+            INNER JOIN sales_ms.Orden o ON od.OrdenId = o.OrdenId
+            INNER JOIN sales_ms.Producto p ON od.ProductoId = p.ProductoId
+            INNER JOIN sales_ms.Cliente c ON o.ClienteId = c.ClienteId
+            {joins}
+            WHERE {filtro}
+            GROUP BY 
+                c.ClienteId, c.Nombre, c.Email, c.Genero, c.Pais, c.FechaRegistro,
+                p.ProductoId, p.SKU, p.Nombre, p.Categoria,
+                CAST(o.Fecha AS DATE), o.Canal
+        """.format(joins=joins, filtro=" AND ".join(conditions))
+    
+    def upsert_facts(self, fact_rows, track_keys=False):
+        """
+        Inserta o actualiza un lote de filas de FactVentas con un único MERGE sobre
+        (IdTiempo, IdProducto, IdCliente, IdCanal). Lo usa la sincronización por
+        Change Tracking para corregir hechos ya cargados.
+        Solo actualiza filas con Fuente = source_system: los hechos que cargan otros
+        ETL en la misma combinación de llaves no se sobrescriben. Si algún grupo del lote
+        coincide con un hecho sin Fuente (cargado antes de la columna), el lote se deshace
+        y se lanza RuntimeError en lugar de insertar una segunda fila.
+        Con track_keys=True las llaves del lote se anotan en #ClavesReconstruidas
+        (ver begin_rebuild).
+        Retorna la cantidad de filas afectadas.
+        """
+        if not fact_rows:
+            return 0
+        
+        with self.metrics.stage('carga_hechos'):
+            affected = self._upsert_staged(fact_rows, track_keys)
+        self.metrics.add_rows('carga_hechos', filas_entrada=len(fact_rows), filas_salida=affected)
+        return affected
+    
+    def _upsert_staged(self, fact_rows, track_keys=False):
+        cursor = self.stage_fact_rows(fact_rows)
+        
+        # Hechos cargados antes de dw/MigracionFuenteFactVentas.sql quedan con Fuente NULL:
+        # el MERGE no los encontraría e insertaría una segunda fila con el total completo
+        cursor.execute("""
+            SELECT COUNT(*)
+            FROM #StageFactVentas s
+            WHERE EXISTS (
+                SELECT 1 FROM FactVentas fv
+                WHERE fv.IdTiempo = s.IdTiempo
+                  AND fv.IdProducto = s.IdProducto
+                  AND fv.IdCliente = s.IdCliente
+                  AND fv.IdCanal = s.IdCanal
+                  AND fv.Fuente IS NULL
+            )
+        """)
+        legacy = cursor.fetchone()[0]
+        if legacy:
+            self.dw_connection.rollback()
+            raise RuntimeError(
+                f"{legacy} grupos coinciden con hechos de FactVentas sin Fuente; asignar la Fuente "
+                f"de esas filas (ver dw/MigracionFuenteFactVentas.sql) antes de usar --change-tracking"
+            )
+        
+        cursor.execute("""
+            MERGE FactVentas AS fv
+            USING #StageFactVentas AS s
+                ON fv.IdTiempo = s.IdTiempo
+               AND fv.IdProducto = s.IdProducto
+               AND fv.IdCliente = s.IdCliente
+               AND fv.IdCanal = s.IdCanal
+               AND fv.Fuente = ?
+            WHEN MATCHED THEN
+                UPDATE SET TotalVentas = s.TotalVentas, Cantidad = s.Cantidad, Precio = s.Precio
+            WHEN NOT MATCHED BY TARGET THEN
+                INSERT (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio, Fuente)
+                VALUES (s.IdTiempo, s.IdProducto, s.IdCliente, s.IdCanal, s.TotalVentas, s.Cantidad, s.Precio, ?);
+        """, (self.source_system, self.source_system))
+        affected = cursor.rowcount
+        
+        if track_keys:
+            cursor.execute("""
+                INSERT INTO #ClavesReconstruidas (IdTiempo, IdProducto, IdCliente, IdCanal)
+                SELECT IdTiempo, IdProducto, IdCliente, IdCanal FROM #StageFactVentas
+            """)
+        self.dw_connection.commit()
+        
+        return affected
+    
+    def extract_ventas(self, query, params, fetch_size, connection=None):
+        """
+        Generador de extracción: ejecuta la consulta en el origen y entrega las filas
+        en bloques de fetchmany(fetch_size), sin materializar todo el resultado.
+        """
+        cursor = (connection or self.source_connection).cursor()
+        cursor.arraysize = fetch_size
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+    
+    def build_date_partitions(self, fecha_min, fecha_max, partition_days):
+        """
+        Divide la ventana [fecha_min, fecha_max] en particiones de partition_days días.
+        Retorna una lista de (inicio, fin_exclusivo) como datetime.
+        """
+        partitions = []
+        inicio = datetime.combine(fecha_min, datetime.min.time())
+        limite = datetime.combine(fecha_max, datetime.min.time()) + timedelta(days=1)
+        while inicio < limite:
+            fin = min(inicio + timedelta(days=partition_days), limite)
+            partitions.append((inicio, fin))
+            inicio = fin
+        return partitions
+    
+    def extract_ventas_parallel(self, conditions, params, fecha_min, fecha_max, fetch_size,
+                                workers, partition_days, timings):
+        """
+        Generador de extracción paralela: divide la ventana en particiones de fechas y
+        las extrae concurrentemente con un pool de hilos, cada uno con su propia conexión
+        pyodbc. Los bloques se entregan por una cola acotada a un único escritor (el
+        consumidor de este generador). Registra en timings el tiempo de cada partición.
+        """
+        partitions = self.build_date_partitions(fecha_min, fecha_max, partition_days)
+        logging.info(f"Extracción paralela: {len(partitions)} particiones de {partition_days} días, {workers} workers")
+        
+        chunk_queue = queue.Queue(maxsize=workers * 2)
+        stop_event = threading.Event()
+        fin_marker = object()
+        
+        def put(item):
+            # No bloquear indefinidamente si el consumidor ya se detuvo
+            while not stop_event.is_set():
                 try:
-                    # Extraer datos del cliente
-                    cliente_data = {
+                    chunk_queue.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+        
+        def extract_partition(partition):
+            inicio, fin = partition
+            started = time.perf_counter()
+            rows_count = 0
+            try:
+                connection = InstrumentedConnection(
+                    pyodbc.connect(self.source_connection_string()), self.metrics, stage='extraccion'
+                )
+                try:
+                    # Rango semiabierto sobre o.Fecha: equivale a CAST(o.Fecha AS DATE) en [inicio, fin)
+                    query = self.build_orders_query(conditions + ["o.Fecha >= ? AND o.Fecha < ?"])
+                    for rows in self.extract_ventas(query, params + [inicio, fin], fetch_size, connection):
+                        if stop_event.is_set():
+                            break
+                        rows_count += len(rows)
+                        put(rows)
+                finally:
+                    connection.close()
+                
+                timings.append({
+                    'inicio': inicio.date(),
+                    'fin': (fin - timedelta(days=1)).date(),
+                    'filas': rows_count,
+                    'segundos': time.perf_counter() - started
+                })
+                put(fin_marker)
+            except Exception as e:
+                put(e)
+        
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for partition in partitions:
+                executor.submit(extract_partition, partition)
+            
+            pending = len(partitions)
+            while pending:
+                item = chunk_queue.get()
+                if item is fin_marker:
+                    pending -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # Detener a los workers si el consumidor termina antes (error o cierre)
+            stop_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+    
+    def transform_ventas(self, chunks):
+        """
+        Generador de transformación: convierte cada fila agregada del origen en un
+        diccionario con los datos de cliente, producto y venta.
+        """
+        for rows in chunks:
+            for venta in rows:
+                yield {
+                    'cliente': {
                         'nombre': venta[1],
                         'email': venta[2],
                         'genero': venta[3],
                         'pais': venta[4],
                         'fecha_registro': venta[5]
-                    }
-                    
-                    # Extraer datos del producto
-                    producto_data = {
+                    },
+                    'producto': {
                         'sku': venta[7],
                         'nombre': venta[8],
                         'categoria': venta[9]
-                    }
-                    
-                    # Datos de la venta (todos los montos están en USD)
-                    fecha = venta[10]
-                    canal = venta[11]
-                    cantidad_total = venta[12]
-                    precio_unit_promedio = venta[13]
-                    total_ventas = venta[14]
-                    
+                    },
+                    # Todos los montos están en USD
+                    'fecha': venta[10],
+                    'canal': venta[11],
+                    'cantidad_total': venta[12],
+                    'precio_unit_promedio': venta[13],
+                    'total_ventas': venta[14]
+                }
+    
+    def process_orders(self, limit=None, bulk_load=None, batch_size=None, since=None, full_refresh=False,
+                       fetch_size=None, workers=None, partition_days=None):
+        """
+        Procesa las órdenes desde SQL Server origen y las carga en FactVentas.
+        Agrupa por cliente, producto y fecha para evitar duplicados.
+        En modo bulk_load las filas se acumulan en lotes de batch_size y se cargan
+        con bulk_insert_facts en lugar de un INSERT por fila.
+        Solo extrae órdenes posteriores a la marca de agua, salvo since/full_refresh.
+        La extracción se consume por bloques de fetch_size (extract -> transform -> load).
+        Con workers > 1 la extracción se reparte en particiones de partition_days días.
+        """
+        if bulk_load is None:
+            bulk_load = self.bulk_load
+        if batch_size is None:
+            batch_size = self.batch_size
+        if fetch_size is None:
+            fetch_size = self.fetch_size
+        if workers is None:
+            workers = self.workers
+        if partition_days is None:
+            partition_days = self.partition_days
+        
+        try:
+            with self.metrics.stage('preparacion'):
+                high_mark = self.get_source_high_mark()
+                if high_mark[0] is None:
+                    logging.info("No hay órdenes en el origen, nada que procesar")
+                    return
+                
+                conditions, params = self.build_extraction_filter(high_mark, since, full_refresh)
+                
+                query = self.build_orders_query(conditions)
+                
+                if limit:
+                    query += f" ORDER BY CAST(o.Fecha AS DATE) DESC OFFSET 0 ROWS FETCH NEXT {limit} ROWS ONLY"
+                
+                # Llaves ya cargadas en el DW para la ventana de fechas a procesar
+                fecha_min, fecha_max = self.get_source_date_window(conditions, params)
+                if fecha_min is None:
+                    logging.info("No hay órdenes nuevas desde la última ejecución")
+                    return
+                existing_keys = self.load_existing_fact_keys(fecha_min, fecha_max)
+                self.warm_dimension_caches()
+                self.prepare_dim_tiempo(fecha_min, fecha_max)
+            
+            logging.info(f"Procesando ventas agregadas en bloques de {fetch_size} registros")
+            
+            extracted_count = 0
+            processed_count = 0
+            error_count = 0
+            skipped_count = 0
+            fact_batch = []
+            load_start = time.perf_counter()
+            
+            partition_timings = []
+            if workers > 1 and not limit:
+                chunks = self.extract_ventas_parallel(
+                    conditions, params, fecha_min, fecha_max, fetch_size,
+                    workers, partition_days, partition_timings
+                )
+            else:
+                chunks = self.extract_ventas(query, params, fetch_size)
+            ventas = self.metrics.timed_iter('extraccion', self.transform_ventas(chunks))
+            
+            for venta in ventas:
+                extracted_count += 1
+                try:
                     # Verificar si esta combinación ya fue procesada
-                    dw_cursor = self.dw_connection.cursor()
-                    check_query = """
-                        SELECT COUNT(*) 
-                        FROM FactVentas fv
-                        INNER JOIN DimCliente c ON fv.IdCliente = c.IdCliente
-                        INNER JOIN DimProducto p ON fv.IdProducto = p.IdProducto
-                        INNER JOIN DimTiempo t ON fv.IdTiempo = t.IdTiempo
-                        WHERE c.Email = ? AND p.SKU = ? AND t.Fecha = ?
-                    """
-                    dw_cursor.execute(check_query, (cliente_data['email'], producto_data['sku'], fecha))
-                    count_result = dw_cursor.fetchone()
-                    
-                    if count_result and count_result[0] > 0:
+                    key = self.fact_key(venta['cliente']['email'], venta['producto']['sku'], venta['fecha'])
+                    if key in existing_keys:
                         skipped_count += 1
                         if skipped_count % 50 == 0:
                             logging.info(f"Registros omitidos (ya procesados): {skipped_count}")
                         continue
                     
-                    # Procesar cliente
-                    cliente_id = self.get_or_create_cliente(cliente_data)
-                    if not cliente_id:
+                    # Resolver cliente, producto, tiempo y canal
+                    with self.metrics.stage('dimensiones'):
+                        fact_row = self.resolve_fact_row(venta)
+                    self.metrics.add_rows('dimensiones', filas_entrada=1, filas_salida=1 if fact_row else 0)
+                    if not fact_row:
                         error_count += 1
                         continue
                     
-                    # Procesar producto con equivalencias
-                    producto_id = self.process_equivalencias_and_get_producto(producto_data)
-                    if not producto_id:
-                        error_count += 1
-                        continue
-                    
-                    # Procesar tiempo
-                    tiempo_id = self.get_or_create_tiempo(fecha)
-                    if not tiempo_id:
-                        error_count += 1
-                        continue
+                    # Registrar la llave para no repetirla en esta misma ejecución
+                    existing_keys.add(key)
                     
-                    # Procesar canal
-                    canal_id = self.get_or_create_canal(canal)
-                    if not canal_id:
-                        error_count += 1
+                    # Modo bulk: acumular la fila y cargar por lotes
+                    if bulk_load:
+                        fact_batch.append(fact_row)
+                        if len(fact_batch) >= batch_size:
+                            processed_count += self.bulk_insert_facts(fact_batch)
+                            fact_batch = []
+                            logging.info(f"Procesados {processed_count} registros nuevos...")
                         continue
                     
                     # Insertar en FactVentas (montos ya están en USD)
                     insert_cursor = self.dw_connection.cursor()
                     insert_query = """
-                        INSERT INTO FactVentas (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                        INSERT INTO FactVentas (IdTiempo, IdProducto, IdCliente, IdCanal, TotalVentas, Cantidad, Precio, Fuente)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                     """
                     
-                    insert_cursor.execute(insert_query, (
-                        tiempo_id,
-                        producto_id,
-                        cliente_id,
-                        canal_id,
-                        round(total_ventas, 2),
-                        cantidad_total,
-                        round(precio_unit_promedio, 2)
-                    ))
+                    with self.metrics.stage('carga_hechos'):
+                        insert_cursor.execute(insert_query, fact_row + (self.source_system,))
+                    self.metrics.add_rows('carga_hechos', filas_entrada=1, filas_salida=1)
                     
                     processed_count += 1
                     
                     if processed_count % 50 == 0:
-                        self.dw_connection.commit()
+                        with self.metrics.stage('carga_hechos'):
+                            self.dw_connection.commit()
                         logging.info(f"Procesados {processed_count} registros nuevos...")
                 
                 except Exception as e:
@@ -478,68 +1280,439 @@ class SQLServerToDW_ETL:
                     error_count += 1
                     continue
             
+            # Cargar el último lote pendiente
+            if fact_batch:
+                processed_count += self.bulk_insert_facts(fact_batch)
+            
             # Commit final
-            self.dw_connection.commit()
+            with self.metrics.stage('carga_hechos'):
+                self.dw_connection.commit()
+            
+            # Avanzar la marca de agua solo si se procesó la ventana completa
+            if limit:
+                logging.info("Ejecución con límite: no se actualiza la marca de agua")
+            elif error_count:
+                logging.warning("Hubo errores: no se actualiza la marca de agua")
+            else:
+                self.save_watermark(*high_mark)
+            
+            elapsed = time.perf_counter() - load_start
+            rows_per_sec = processed_count / elapsed if elapsed > 0 else 0.0
+            
+            peak_rss = get_peak_rss_mb()
             
             logging.info(f"ETL completado:")
+            logging.info(f"  - Modo de carga: {'bulk (lotes de ' + str(batch_size) + ')' if bulk_load else 'fila por fila'}")
+            logging.info(f"  - Registros extraídos: {extracted_count}")
             logging.info(f"  - Registros procesados: {processed_count}")
             logging.info(f"  - Registros omitidos (duplicados): {skipped_count}")
             logging.info(f"  - Errores: {error_count}")
+            logging.info(f"  - Tiempo de carga: {elapsed:.2f}s ({rows_per_sec:.1f} filas/s)")
+            if peak_rss is not None:
+                logging.info(f"  - Pico de memoria (RSS): {peak_rss:.1f} MB")
+            for cache in (self.cliente_cache, self.producto_cache, self.tiempo_cache, self.canal_cache):
+                logging.info(
+                    f"  - Caché {cache.name}: {cache.hits} aciertos, {cache.misses} fallos "
+                    f"({cache.hit_rate():.1%} de aciertos)"
+                )
+            for timing in sorted(partition_timings, key=lambda t: t['inicio']):
+                logging.info(
+                    f"  - Partición {timing['inicio']} a {timing['fin']}: "
+                    f"{timing['filas']} filas en {timing['segundos']:.2f}s"
+                )
             
         except Exception as e:
             logging.error(f"Error en process_orders: {e}")
             raise
     
-    def load_exchange_rates_from_file(self, filepath='tipos_cambio.csv'):
+    def parse_exchange_rate_rows(self, lines, first_line):
+        """
+        Convierte un bloque de líneas del CSV de tipos de cambio en tuplas
+        (Linea, Fecha, MonedaOrigen, MonedaDestino, Tasa). Las líneas inválidas se omiten.
+        Retorna (filas, cantidad_invalidas).
+        """
+        rows = []
+        invalid = 0
+        for offset, row in enumerate(lines):
+            try:
+                rows.append((
+                    first_line + offset,
+                    datetime.strptime(row['Fecha'].strip(), '%Y-%m-%d').date(),
+                    row['MonedaOrigen'].strip(),
+                    row['MonedaDestino'].strip(),
+                    float(row['Tasa'])
+                ))
+            except Exception as e:
+                invalid += 1
+                logging.warning(f"Línea {first_line + offset} inválida en tipos de cambio: {e}")
+        return rows, invalid
+    
+    def read_change_tracking_version(self):
+        """
+        Lee la última versión de Change Tracking sincronizada.
+        Retorna None si no hay sincronizaciones previas.
+        """
+        try:
+            if not os.path.exists(self.change_tracking_path):
+                return None
+            with open(self.change_tracking_path, 'r', encoding='utf-8') as f:
+                return int(json.load(f)['version'])
+        except Exception as e:
+            logging.error(f"Error leyendo versión de Change Tracking: {e}")
+            return None
+    
+    def save_change_tracking_version(self, version):
+        """Persiste la versión de Change Tracking sincronizada (archivo temporal + reemplazo)"""
+        try:
+            tmp_path = self.change_tracking_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': int(version)}, f)
+            os.replace(tmp_path, self.change_tracking_path)
+            logging.info(f"Versión de Change Tracking actualizada: {version}")
+        except Exception as e:
+            logging.error(f"Error guardando versión de Change Tracking: {e}")
+    
+    def load_affected_keys(self, last_version):
+        """
+        Materializa en la tabla temporal #ClavesAfectadas (conexión de origen) los grupos
+        (ClienteId, ProductoId, Fecha, Canal) de las órdenes cambiadas en Orden u OrdenDetalle
+        desde last_version. El costo depende del volumen de cambios, no del tamaño del origen.
+        Retorna (cantidad_grupos, fecha_min, fecha_max).
+        """
+        cursor = self.source_connection.cursor()
+        
+        # Se crea sin parámetros para que la tabla temporal viva en la sesión y no solo en el lote
+        cursor.execute("""
+            IF OBJECT_ID('tempdb..#ClavesAfectadas') IS NOT NULL
+                DROP TABLE #ClavesAfectadas;
+            CREATE TABLE #ClavesAfectadas (
+                ClienteId INT NOT NULL,
+                ProductoId INT NOT NULL,
+                Fecha DATE NOT NULL,
+                Canal NVARCHAR(20) NOT NULL,
+                PRIMARY KEY (ClienteId, ProductoId, Fecha, Canal)
+            );
+        """)
+        cursor.execute("""
+            INSERT INTO #ClavesAfectadas (ClienteId, ProductoId, Fecha, Canal)
+            SELECT DISTINCT o.ClienteId, od.ProductoId, CAST(o.Fecha AS DATE), o.Canal
+            FROM (
+                SELECT cto.OrdenId FROM CHANGETABLE(CHANGES sales_ms.Orden, ?) cto
+                UNION
+                SELECT d.OrdenId
+                FROM CHANGETABLE(CHANGES sales_ms.OrdenDetalle, ?) ctd
+                INNER JOIN sales_ms.OrdenDetalle d ON d.OrdenDetalleId = ctd.OrdenDetalleId
+            ) cambios
+            INNER JOIN sales_ms.Orden o ON o.OrdenId = cambios.OrdenId
+            INNER JOIN sales_ms.OrdenDetalle od ON od.OrdenId = o.OrdenId
+        """, (last_version, last_version))
+        
+        cursor.execute("SELECT COUNT(*), MIN(Fecha), MAX(Fecha) FROM #ClavesAfectadas")
+        affected, fecha_min, fecha_max = cursor.fetchone()
+        cursor.close()
+        return affected, fecha_min, fecha_max
+    
+    def count_key_changes(self, last_version):
+        """
+        Cuenta los cambios desde last_version que sacan filas de su grupo anterior:
+        borrados en Orden u OrdenDetalle y actualizaciones de Orden.ClienteId/Fecha/Canal
+        u OrdenDetalle.OrdenId/ProductoId. Change Tracking no guarda los valores viejos,
+        así que esos grupos no se pueden re-agregar desde el origen.
+        Una actualización sin máscara de columnas (TRACK_COLUMNS_UPDATED apagado) también cuenta.
+        """
+        def key_changes_query(table, columns):
+            masks = " OR ".join(
+                f"CHANGE_TRACKING_IS_COLUMN_IN_MASK("
+                f"COLUMNPROPERTY(OBJECT_ID('{table}'), '{column}', 'ColumnId'), ct.SYS_CHANGE_COLUMNS) = 1"
+                for column in columns
+            )
+            return f"""
+                SELECT COUNT(*) FROM CHANGETABLE(CHANGES {table}, ?) ct
+                WHERE ct.SYS_CHANGE_OPERATION = 'D'
+                   OR (ct.SYS_CHANGE_OPERATION = 'U' AND (ct.SYS_CHANGE_COLUMNS IS NULL OR {masks}))
+            """
+        
+        cursor = self.source_connection.cursor()
+        cursor.execute(
+            f"SELECT ({key_changes_query('sales_ms.Orden', ['ClienteId', 'Fecha', 'Canal'])}), "
+            f"({key_changes_query('sales_ms.OrdenDetalle', ['OrdenId', 'ProductoId'])})",
+            (last_version, last_version)
+        )
+        orden_changes, detalle_changes = cursor.fetchone()
+        cursor.close()
+        return orden_changes + detalle_changes
+    
+    def begin_rebuild(self):
+        """
+        Prepara la reconstrucción de los hechos de este ETL: la tabla temporal
+        #ClavesReconstruidas (conexión del DW) anota las llaves que aplica cada MERGE.
+        """
+        cursor = self.dw_connection.cursor()
+        # Sin parámetros para que la tabla temporal viva en la sesión
+        cursor.execute("""
+            IF OBJECT_ID('tempdb..#ClavesReconstruidas') IS NOT NULL
+                DROP TABLE #ClavesReconstruidas;
+            CREATE TABLE #ClavesReconstruidas (
+                IdTiempo INT NOT NULL,
+                IdProducto INT NOT NULL,
+                IdCliente INT NOT NULL,
+                IdCanal INT NOT NULL,
+                PRIMARY KEY (IdTiempo, IdProducto, IdCliente, IdCanal)
+            );
+        """)
+        self.dw_connection.commit()
+        cursor.close()
+    
+    def delete_stale_facts(self):
+        """
+        Cierra la reconstrucción: borra los hechos de este ETL cuyas llaves no salieron
+        en la re-agregación completa (grupos que ya no tienen ventas en el origen).
+        Retorna la cantidad de filas borradas.
+        """
+        cursor = self.dw_connection.cursor()
+        cursor.execute("""
+            DELETE fv
+            FROM FactVentas fv
+            WHERE fv.Fuente = ?
+              AND NOT EXISTS (
+                SELECT 1 FROM #ClavesReconstruidas k
+                WHERE k.IdTiempo = fv.IdTiempo
+                  AND k.IdProducto = fv.IdProducto
+                  AND k.IdCliente = fv.IdCliente
+                  AND k.IdCanal = fv.IdCanal
+              )
+        """, self.source_system)
+        deleted = cursor.rowcount
+        self.dw_connection.commit()
+        cursor.close()
+        return deleted
+    
+    def process_changes(self, batch_size=None, fetch_size=None):
+        """
+        Sincronización incremental con SQL Server Change Tracking sobre Orden y OrdenDetalle.
+        Obtiene las órdenes cambiadas desde la última versión sincronizada, materializa los
+        grupos (cliente, producto, fecha, canal) afectados en #ClavesAfectadas, re-agrega solo
+        esos grupos y los aplica en FactVentas con MERGE (upsert). Sin versión previa, si la
+        versión ya no es válida, o si hubo borrados o cambios de llave (count_key_changes),
+        reconstruye: re-agrega todo el origen con el mismo MERGE y al final borra los hechos
+        de SQL Server que no salieron (grupos viejos que quedaron sin ventas).
+        Requiere HabilitarChangeTracking.sql en ventas_ms.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        if fetch_size is None:
+            fetch_size = self.fetch_size
+        
+        try:
+            cursor = self.source_connection.cursor()
+            cursor.execute("""
+                SELECT
+                    CHANGE_TRACKING_CURRENT_VERSION(),
+                    CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID('sales_ms.Orden')),
+                    CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID('sales_ms.OrdenDetalle'))
+            """)
+            current_version, min_orden, min_detalle = cursor.fetchone()
+            cursor.close()
+            
+            if current_version is None or min_orden is None or min_detalle is None:
+                raise RuntimeError("Change Tracking no está habilitado en ventas_ms (ver HabilitarChangeTracking.sql)")
+            
+            last_version = self.read_change_tracking_version()
+            
+            rebuild = False
+            if last_version is None or last_version < max(min_orden, min_detalle):
+                logging.warning(
+                    "Sin versión de Change Tracking válida: se reconstruyen todas las ventas del origen"
+                )
+                rebuild = True
+            else:
+                key_changes = self.count_key_changes(last_version)
+                if key_changes:
+                    logging.warning(
+                        f"{key_changes} borrados o cambios de llave en Orden/OrdenDetalle: sus grupos "
+                        f"anteriores no se conocen, se reconstruyen todas las ventas del origen"
+                    )
+                    rebuild = True
+            
+            if rebuild:
+                conditions = ["1 = 1"]
+                params = []
+                joins = ""
+                fecha_min, fecha_max = self.get_source_date_window()
+                self.begin_rebuild()
+            else:
+                logging.info(f"Cambios desde la versión {last_version} hasta {current_version}")
+                affected, fecha_min, fecha_max = self.load_affected_keys(last_version)
+                if not affected:
+                    logging.info("No hay grupos de ventas afectados por los cambios")
+                    self.save_change_tracking_version(current_version)
+                    return
+                logging.info(f"Grupos afectados: {affected} ({fecha_min} a {fecha_max})")
+                # Re-agregar solo esos grupos: join contra la tabla temporal y rango de fechas
+                # (IX_Orden_Fecha) para no recorrer todo el origen
+                joins = """INNER JOIN #ClavesAfectadas k
+                ON k.ClienteId = o.ClienteId
+               AND k.ProductoId = od.ProductoId
+               AND k.Fecha = CAST(o.Fecha AS DATE)
+               AND k.Canal = o.Canal"""
+                conditions = ["o.Fecha >= ?", "o.Fecha < ?"]
+                params = [fecha_min, fecha_max + timedelta(days=1)]
+            
+            query = self.build_orders_query(conditions, joins)
+            with self.metrics.stage('preparacion'):
+                self.warm_dimension_caches()
+                # Calendario en bloque para la ventana (fechas nuevas con TipoCambio NULL)
+                self.prepare_dim_tiempo(fecha_min, fecha_max)
+            
+            extracted_count = 0
+            upserted_count = 0
+            error_count = 0
+            fact_batch = []
+            load_start = time.perf_counter()
+            
+            ventas = self.transform_ventas(self.extract_ventas(query, params, fetch_size))
+            for venta in self.metrics.timed_iter('extraccion', ventas):
+                extracted_count += 1
+                try:
+                    with self.metrics.stage('dimensiones'):
+                        fact_row = self.resolve_fact_row(venta)
+                    self.metrics.add_rows('dimensiones', filas_entrada=1, filas_salida=1 if fact_row else 0)
+                    if not fact_row:
+                        error_count += 1
+                        continue
+                    fact_batch.append(fact_row)
+                except Exception as e:
+                    logging.error(f"Error procesando cambio de venta: {e}")
+                    error_count += 1
+                    continue
+                
+                # Fuera del try: un lote que choca con hechos sin Fuente detiene la sincronización
+                if len(fact_batch) >= batch_size:
+                    upserted_count += self.upsert_facts(fact_batch, track_keys=rebuild)
+                    fact_batch = []
+                    logging.info(f"Grupos aplicados: {upserted_count}...")
+            
+            if fact_batch:
+                upserted_count += self.upsert_facts(fact_batch, track_keys=rebuild)
+            
+            # La versión se toma antes de extraer: los cambios concurrentes se verán en la próxima ejecución
+            # Con errores faltan grupos en #ClavesReconstruidas: no se borra nada y se repite la próxima vez
+            deleted_count = 0
+            if error_count:
+                logging.warning("Hubo errores: no se actualiza la versión de Change Tracking")
+            else:
+                if rebuild:
+                    with self.metrics.stage('carga_hechos'):
+                        deleted_count = self.delete_stale_facts()
+                self.save_change_tracking_version(current_version)
+            
+            elapsed = time.perf_counter() - load_start
+            logging.info(f"Sincronización por Change Tracking completada:")
+            logging.info(f"  - Grupos re-agregados: {extracted_count}")
+            logging.info(f"  - Filas de FactVentas insertadas/actualizadas: {upserted_count}")
+            if rebuild:
+                logging.info(f"  - Filas de FactVentas borradas (grupos sin ventas): {deleted_count}")
+            logging.info(f"  - Errores: {error_count}")
+            logging.info(f"  - Tiempo: {elapsed:.2f}s")
+            
+        except Exception as e:
+            logging.error(f"Error en process_changes: {e}")
+            raise
+    
+    def load_exchange_rates_from_file(self, filepath='tipos_cambio.csv', chunk_size=None):
         """
         Carga tipos de cambio desde un archivo CSV.
         Formato esperado: Fecha,MonedaOrigen,MonedaDestino,Tasa
         Ejemplo: 2025-01-01,CRC,USD,0.0019
+        El archivo se lee por bloques de chunk_size líneas que se envían a la tabla
+        temporal #StageTipoCambio con fast_executemany; al final un único INSERT ... SELECT
+        agrega solo las llaves (Fecha, MonedaOrigen, MonedaDestino) que no existen.
         """
+        if chunk_size is None:
+            chunk_size = self.batch_size
+        
         try:
             import csv
-            from datetime import datetime as dt
+            from itertools import islice
             
             if not os.path.exists(filepath):
                 logging.warning(f"Archivo {filepath} no encontrado, saltando carga de tipos de cambio")
                 return
             
             cursor = self.dw_connection.cursor()
-            inserted = 0
+            cursor.fast_executemany = True
+            
+            cursor.execute("""
+                IF OBJECT_ID('tempdb..#StageTipoCambio') IS NOT NULL
+                    DROP TABLE #StageTipoCambio
+            """)
+            cursor.execute("""
+                CREATE TABLE #StageTipoCambio (
+                    Linea INT NOT NULL,
+                    Fecha DATE NOT NULL,
+                    MonedaOrigen VARCHAR(10) NOT NULL,
+                    MonedaDestino VARCHAR(10) NOT NULL,
+                    Tasa FLOAT NOT NULL
+                )
+            """)
             
-            with open(filepath, 'r') as f:
+            staged = 0
+            invalid = 0
+            
+            with open(filepath, 'r', newline='') as f:
                 reader = csv.DictReader(f)
-                for row in reader:
-                    try:
-                        fecha = dt.strptime(row['Fecha'], '%Y-%m-%d').date()
-                        moneda_origen = row['MonedaOrigen']
-                        moneda_destino = row['MonedaDestino']
-                        tasa = float(row['Tasa'])
-                        
-                        # Verificar si ya existe
-                        check_query = """
-                            SELECT COUNT(*) FROM dbo.TipoCambio 
-                            WHERE Fecha = ? AND MonedaOrigen = ? AND MonedaDestino = ?
-                        """
-                        cursor.execute(check_query, (fecha, moneda_origen, moneda_destino))
-                        if cursor.fetchone()[0] == 0:
-                            insert_query = """
-                                INSERT INTO dbo.TipoCambio (Fecha, MonedaOrigen, MonedaDestino, Tasa)
-                                VALUES (?, ?, ?, ?)
-                            """
-                            cursor.execute(insert_query, (fecha, moneda_origen, moneda_destino, tasa))
-                            inserted += 1
-                    except Exception as e:
-                        logging.warning(f"Error insertando tipo de cambio: {e}")
-                        continue
+                # La línea 1 es el encabezado
+                next_line = 2
+                while True:
+                    lines = list(islice(reader, chunk_size))
+                    if not lines:
+                        break
+                    rows, chunk_invalid = self.parse_exchange_rate_rows(lines, next_line)
+                    next_line += len(lines)
+                    invalid += chunk_invalid
+                    if rows:
+                        cursor.executemany("""
+                            INSERT INTO #StageTipoCambio (Linea, Fecha, MonedaOrigen, MonedaDestino, Tasa)
+                            VALUES (?, ?, ?, ?, ?)
+                        """, rows)
+                        staged += len(rows)
+            
+            # Diferencia contra las llaves existentes en un solo paso; si una llave se
+            # repite en el archivo se conserva la primera aparición
+            cursor.execute("""
+                INSERT INTO dbo.TipoCambio (Fecha, MonedaOrigen, MonedaDestino, Tasa)
+                SELECT s.Fecha, s.MonedaOrigen, s.MonedaDestino, s.Tasa
+                FROM (
+                    SELECT Fecha, MonedaOrigen, MonedaDestino, Tasa,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY Fecha, MonedaOrigen, MonedaDestino ORDER BY Linea
+                           ) AS rn
+                    FROM #StageTipoCambio
+                ) s
+                WHERE s.rn = 1
+                  AND NOT EXISTS (
+                      SELECT 1 FROM dbo.TipoCambio tc
+                      WHERE tc.Fecha = s.Fecha
+                        AND tc.MonedaOrigen = s.MonedaOrigen
+                        AND tc.MonedaDestino = s.MonedaDestino
+                  )
+            """)
+            inserted = cursor.rowcount
+            cursor.execute("DROP TABLE #StageTipoCambio")
             
             self.dw_connection.commit()
-            logging.info(f"Tipos de cambio cargados desde archivo: {inserted} registros nuevos")
+            logging.info(
+                f"Tipos de cambio cargados desde archivo: {inserted} registros nuevos "
+                f"({staged} leídos, {invalid} inválidos)"
+            )
             
         except Exception as e:
+            self.dw_connection.rollback()
             logging.error(f"Error cargando tipos de cambio desde archivo: {e}")
     
-    def run_etl(self, limit=None, load_exchange_rates=True):
+    def run_etl(self, limit=None, load_exchange_rates=True, bulk_load=None, batch_size=None,
+                since=None, full_refresh=False, fetch_size=None, workers=None, partition_days=None,
+                change_tracking=False):
         """Ejecuta el proceso completo de ETL"""
         try:
             logging.info("="*60)
@@ -552,10 +1725,23 @@ class SQLServerToDW_ETL:
             
             # Cargar tipos de cambio si está habilitado
             if load_exchange_rates:
-                self.load_exchange_rates_from_file()
+                with self.metrics.stage('tipos_cambio'):
+                    self.load_exchange_rates_from_file()
             
-            # Procesar órdenes
-            self.process_orders(limit)
+            # Procesar órdenes (solo cambios si se usa Change Tracking)
+            if change_tracking:
+                self.process_changes(batch_size=batch_size, fetch_size=fetch_size)
+            else:
+                self.process_orders(
+                    limit,
+                    bulk_load=bulk_load,
+                    batch_size=batch_size,
+                    since=since,
+                    full_refresh=full_refresh,
+                    fetch_size=fetch_size,
+                    workers=workers,
+                    partition_days=partition_days
+                )
             
             logging.info("="*60)
             logging.info("ETL completado exitosamente")
@@ -565,6 +1751,12 @@ class SQLServerToDW_ETL:
             logging.error(f"Error en ETL: {e}")
             raise
         finally:
+            # Reporte de la ejecución por etapas (también si falló)
+            try:
+                self.metrics.write_reports(self.report_json_path, self.report_prometheus_path)
+            except Exception as e:
+                logging.error(f"Error escribiendo reporte de ejecución: {e}")
+            
             # Cerrar conexiones
             if self.source_connection:
                 self.source_connection.close()
@@ -576,6 +1768,42 @@ class SQLServerToDW_ETL:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ETL SQL Server (ventas_ms) -> Data Warehouse (DW_VENTAS)')
+    parser.add_argument('--limit', type=int, default=None, help='Máximo de registros agregados a procesar')
+    parser.add_argument('--row-by-row', dest='bulk_load', action='store_false', default=None,
+                        help='Insertar FactVentas fila por fila en lugar de la carga masiva por lotes')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Tamaño de lote para la carga masiva (default: ETL_BATCH_SIZE o 5000)')
+    parser.add_argument('--fetch-size', type=int, default=None,
+                        help='Filas por fetchmany al leer el origen (default: ETL_FETCH_SIZE o 5000)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Hilos de extracción paralela por particiones de fechas (default: ETL_WORKERS o 1)')
+    parser.add_argument('--partition-days', type=int, default=None,
+                        help='Días por partición en la extracción paralela (default: ETL_PARTITION_DAYS o 30)')
+    parser.add_argument('--change-tracking', action='store_true',
+                        help='Sincronizar solo los cambios registrados por Change Tracking (upsert en FactVentas)')
+    parser.add_argument('--skip-exchange-rates', dest='load_exchange_rates', action='store_false',
+                        help='No cargar tipos de cambio desde archivo')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='Ignorar la marca de agua y extraer todas las órdenes')
+    parser.add_argument('--since', type=lambda v: datetime.strptime(v, '%Y-%m-%d'), default=None,
+                        help='Extraer órdenes desde esta fecha (YYYY-MM-DD) para backfills')
+    args = parser.parse_args()
+    
+    if args.full_refresh and args.since:
+        parser.error('--full-refresh y --since no se pueden usar juntos')
+    
     etl = SQLServerToDW_ETL()
-    # Ejecutar sin límite para procesar todos los registros
-    etl.run_etl()
+    # Sin --limit se procesan todos los registros
+    etl.run_etl(
+        limit=args.limit,
+        load_exchange_rates=args.load_exchange_rates,
+        bulk_load=args.bulk_load,
+        batch_size=args.batch_size,
+        since=args.since,
+        full_refresh=args.full_refresh,
+        fetch_size=args.fetch_size,
+        workers=args.workers,
+        partition_days=args.partition_days,
+        change_tracking=args.change_tracking
+    )
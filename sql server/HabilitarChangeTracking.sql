@@ -0,0 +1,15 @@
+-- Habilita Change Tracking en ventas_ms para la sincronización incremental del ETL
+-- (python ETL_SQLSERVER_TO_DW.py --change-tracking)
+USE ventas_ms;
+GO
+
+ALTER DATABASE ventas_ms
+SET CHANGE_TRACKING = ON (CHANGE_RETENTION = 7 DAYS, AUTO_CLEANUP = ON);
+GO
+
+-- TRACK_COLUMNS_UPDATED permite distinguir los cambios de llave (cliente, fecha, canal,
+-- producto), que obligan a reconstruir, de los de cantidad/precio/descuento.
+-- Si las tablas ya tenían Change Tracking sin esta opción: DISABLE CHANGE_TRACKING y volver a correr.
+ALTER TABLE sales_ms.Orden ENABLE CHANGE_TRACKING WITH (TRACK_COLUMNS_UPDATED = ON);
+ALTER TABLE sales_ms.OrdenDetalle ENABLE CHANGE_TRACKING WITH (TRACK_COLUMNS_UPDATED = ON);
+GO